@@ -1,5 +1,10 @@
 import os
+import queue
+import random
+import argparse
 import itertools
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
 import albumentations as A
@@ -8,6 +13,9 @@ from matplotlib import pyplot as plt
 from skimage.io import imread, imsave
 from PIL import Image
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+
+from patch_sampler import augmentation_counts
 
 # Directories configuration
 home_path = os.path.expanduser("~")
@@ -21,6 +29,94 @@ patch_size = 224
 
 Image.MAX_IMAGE_PIXELS = None
 
+# Define transforms
+transform = A.Compose(
+    [
+        A.RandomCrop(width=224, height=224),
+        A.HorizontalFlip(p=0.5),
+        A.RandomBrightnessContrast(p=0.2),
+    ]
+)
+
+
+# Every worker saves its augmented patches from a writer thread fed by a bounded
+# queue, so the files are written while the next transforms are computed and at most
+# queue_size augmented patches are held in memory by each worker
+def init_worker(queue_size):
+    global write_queue, write_errors
+    # Forked workers inherit the random state of the parent, reseed them so every
+    # worker draws different augmentations
+    random.seed()
+    np.random.seed()
+    write_queue = queue.Queue(maxsize=queue_size)
+    write_errors = []
+    threading.Thread(target=write_patches, daemon=True).start()
+
+
+def write_patches():
+    while True:
+        path, patch = write_queue.get()
+        try:
+            imsave(path, patch, check_contrast=False)
+        except Exception as e:
+            write_errors.append(e)
+        write_queue.task_done()
+
+
+# Augment a batch of (patch name, number of augmentations) pairs, returns once all
+# the augmented patches of the batch are saved
+def augment_batch(batch):
+    for patch_name, num_of_patches in batch:
+        patch_image = imread(
+            os.path.join(dst_path, "features", "origin", patch_name + ".tif")
+        )
+        patch_label = imread(os.path.join(dst_path, "labels", patch_name + ".png"))
+        for i in range(num_of_patches):
+            # Apply augmentation and save
+            transformed = transform(image=patch_image, mask=patch_label)
+            write_queue.put(
+                (
+                    os.path.join(
+                        dst_path, "features", "origin", patch_name + f"_aug{i:03d}.tif"
+                    ),
+                    transformed["image"],
+                )
+            )
+            write_queue.put(
+                (
+                    os.path.join(dst_path, "labels", patch_name + f"_aug{i:03d}.png"),
+                    transformed["mask"],
+                )
+            )
+    write_queue.join()
+    if write_errors:
+        raise write_errors.pop()
+    return len(batch)
+
+
+parser = argparse.ArgumentParser(
+    prog="AugmentPatches", description="Augment the patches with oil pixels"
+)
+parser.add_argument(
+    "--workers", type=int, default=os.cpu_count(), help="Augmentation processes"
+)
+parser.add_argument(
+    "--batch-size", type=int, default=8, help="Patches augmented by each pool task"
+)
+parser.add_argument(
+    "--queue-size",
+    type=int,
+    default=64,
+    help="Augmented patches waiting to be saved on each worker",
+)
+parser.add_argument(
+    "--plan",
+    help="Plan file of plan_augmentation_patches.py with the number of "
+    "augmentations of every patch, instead of one for every percent of oil",
+)
+args = parser.parse_args()
+print(args)
+
 # Get total oil and sea pixels
 mask_totals_df = pd.read_csv(
     os.path.join(dst_path, "counts", "totals", "total_count.csv")
@@ -28,19 +124,31 @@ mask_totals_df = pd.read_csv(
 total_oil_pixels = mask_totals_df["oil_pixels"].iloc[0]
 total_sea_pixels = mask_totals_df["sea_pixels"].iloc[0]
 total_pixels = total_oil_pixels + total_sea_pixels
-# Open list of patches counts per image
-image_patches_dfs = []
+# Open list of patches counts per image, keeping only the patches with at least 10%
+# of oil pixels (those to augment) and the number of augmentations of each one,
+# unless they are given by a plan
+total_mask_patches = 0
+augment_patches_dfs = []
 for fname in os.listdir(os.path.join(src_path, "image_norm")):
     image_patches_df = pd.read_csv(
-        os.path.join(dst_path, "counts", "images", fname.split(".")[0] + ".csv")
+        os.path.join(dst_path, "counts", "images", fname.split(".")[0] + ".csv"),
+        usecols=["patch_name", "total_pixels", "oil_pixels", "sea_pixels"],
     )
-    image_patches_dfs.append(image_patches_df)
-# Join dataframe
-mask_images_patches = pd.concat(image_patches_dfs)
-print("Mask images patches: ", len(mask_images_patches))
-total_mask_patches = len(mask_images_patches)
-# Sort by oil pixels (descending)
-mask_images_patches = mask_images_patches.sort_values("oil_pixels", ascending=False)
+    total_mask_patches += len(image_patches_df)
+    if args.plan is None:
+        image_patches_df["num_of_patches"] = augmentation_counts(
+            image_patches_df["oil_pixels"], image_patches_df["total_pixels"]
+        )
+        augment_patches_dfs.append(
+            image_patches_df[image_patches_df["num_of_patches"] > 0]
+        )
+print("Mask images patches: ", total_mask_patches)
+if args.plan is not None:
+    augment_patches_dfs = [pd.read_csv(args.plan)]
+# Join dataframe, sorted by oil pixels (descending) so the largest tasks go first
+augment_patches = pd.concat(augment_patches_dfs).sort_values(
+    "oil_pixels", ascending=False
+)
 
 print(
     f"Initial total pixel counts, oil: {total_oil_pixels}, sea: {total_sea_pixels}, total: {total_pixels}"
@@ -48,62 +156,47 @@ print(
 print(
     f"Percentage of pixel counts, oil: {round(total_oil_pixels/total_pixels,2)}, sea: {round(total_sea_pixels/total_pixels,2)}"
 )
-# Define transforms
-transform = A.Compose(
-    [
-        A.RandomCrop(width=224, height=224),
-        A.HorizontalFlip(p=0.5),
-        A.RandomBrightnessContrast(p=0.2),
-    ]
+# Augment the patches with more than 10% of oil pixels, once for every percent of
+# oil (or as given by the plan), on a pool of processes working on batches of patches
+augment_list = list(
+    zip(augment_patches["patch_name"], augment_patches["num_of_patches"].tolist())
 )
-# Iterate over list of patches augmenting those with more than 10% of oil pixels until we have approximate the equal
-augmented_oil_pixels = 0
-augmented_sea_pixels = 0
-for index, row in tqdm(mask_images_patches.iterrows()):
-    patch_oil_pixels = row["oil_pixels"]
-    patch_sea_pixels = row["sea_pixels"]
-    patch_total_pixels = row["total_pixels"]
-    patch_percentage_oil_pixels = round(patch_oil_pixels / patch_total_pixels * 100, 2)
-    if patch_percentage_oil_pixels >= 10.0:
-        num_of_patches = int(round(patch_percentage_oil_pixels, 0))
-        patch_name = row["patch_name"]
-        patch_image = imread(
-            os.path.join(dst_path, "features", "origin", patch_name + ".tif")
-        )
-        patch_label = imread(os.path.join(dst_path, "labels", patch_name + ".png"))
-        for i in range(num_of_patches):
-            # Apply augmentation and save
-            transformed = transform(image=patch_image, mask=patch_label)
-            transformed_image = transformed["image"]
-            transformed_mask = transformed["mask"]
-            # Save
-            imsave(
-                os.path.join(
-                    dst_path, "features", "origin", patch_name + f"_aug{i:03d}.tif"
-                ),
-                transformed_image,
-                check_contrast=False,
-            )
-            imsave(
-                os.path.join(dst_path, "labels", patch_name + f"_aug{i:03d}.png"),
-                transformed_mask,
-                check_contrast=False,
-            )
+batches = [
+    augment_list[start : start + args.batch_size]
+    for start in range(0, len(augment_list), args.batch_size)
+]
+with ProcessPoolExecutor(
+    max_workers=args.workers,
+    mp_context=multiprocessing.get_context("fork"),
+    initializer=init_worker,
+    initargs=(args.queue_size,),
+) as executor:
+    with tqdm(total=len(augment_list)) as progress:
+        for batch_patches in executor.map(augment_batch, batches):
+            progress.update(batch_patches)
 
-        augmented_oil_pixels += patch_oil_pixels * num_of_patches
-        augmented_sea_pixels += patch_sea_pixels * num_of_patches
-        total_mask_patches += num_of_patches
+augmented_oil_pixels = int(
+    (augment_patches["oil_pixels"] * augment_patches["num_of_patches"]).sum()
+)
+augmented_sea_pixels = int(
+    (augment_patches["sea_pixels"] * augment_patches["num_of_patches"]).sum()
+)
+total_mask_patches += int(augment_patches["num_of_patches"].sum())
 
 # total of oil and sea pixels
 augmented_total_pixels = augmented_oil_pixels + augmented_sea_pixels
 print(
     f"Augmented total pixel counts, oil: {augmented_oil_pixels}, sea: {augmented_sea_pixels}, total: {augmented_total_pixels}"
 )
-percentage_oil_pixels = round(augmented_oil_pixels / augmented_total_pixels, 2)
-percentage_sea_pixels = round(augmented_sea_pixels / augmented_total_pixels, 2)
-print(
-    f"Percentage of augmented pixel counts, oil: {percentage_oil_pixels}, sea: {percentage_sea_pixels}"
-)
+if augmented_total_pixels > 0:
+    percentage_oil_pixels = round(augmented_oil_pixels / augmented_total_pixels, 2)
+    percentage_sea_pixels = round(augmented_sea_pixels / augmented_total_pixels, 2)
+    print(
+        f"Percentage of augmented pixel counts, oil: {percentage_oil_pixels}, sea: {percentage_sea_pixels}"
+    )
+else:
+    # Empty plan, the oil fraction of the patches already reaches the target
+    print("No patches to augment")
 total_oil_pixels += augmented_oil_pixels
 total_sea_pixels += augmented_sea_pixels
 total_pixels = total_oil_pixels + total_sea_pixels
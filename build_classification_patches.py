@@ -1,12 +1,17 @@
 import os
-import itertools
+import argparse
 import numpy as np
-import pandas as pd
 
-from skimage.io import imread, imsave
+from skimage.io import imsave
 from PIL import Image
 from tqdm import tqdm
 
+from patch_grid import classify_patches, grid_size, patch_rows
+from patch_manifest import SceneManifest
+from raster_io import TileReader, raster_shape
+from scene_stats import get_scene_stats
+from task_executor import map_workers, results_table
+
 # Directories configuration
 home_path = os.path.expanduser("~")
 data_path = os.path.join(home_path, "data", "cimat")
@@ -30,6 +35,7 @@ def patchify_image(
     img_name,
     patch_size,
     max_not_oil_patches=None,
+    force=False,
 ):
     print(
         src_path,
@@ -41,81 +47,80 @@ def patchify_image(
         img_name,
         patch_size,
     )
+    # Scenes already built with the current image, mask and options are skipped
+    manifest = SceneManifest(
+        dst_path,
+        "classification",
+        img_name,
+        [
+            os.path.join(src_path, img_dir, img_name + ".tif"),
+            os.path.join(src_path, mask_dir, img_name + ".png"),
+        ],
+        {"patch_size": patch_size, "max_not_oil_patches": max_not_oil_patches},
+        force,
+    )
+    if manifest.result() is not None:
+        print(f"{img_name} up to date")
+        return tuple(manifest.result())
     # In this case we are opening both image and mask to patchify at the same time
     # considering that we are removing outside regions pixels (SAR image) and separating
-    # oil from not oil spill patches
-    image = imread(os.path.join(src_path, img_dir, img_name + ".tif"), as_gray=True)
-    mask = imread(os.path.join(src_path, mask_dir, img_name + ".png"), as_gray=True)
+    # oil from not oil spill patches. The patches are classified from the scene
+    # statistics sidecar and only the saved ones are read, by windows
+    stats = get_scene_stats(src_path, img_dir, img_name, patch_size, mask_dir)
+    image_reader = TileReader(os.path.join(src_path, img_dir, img_name + ".tif"))
     # Scale image between 0 and 1
-    min_image = np.min(image)
-    max_image = np.max(image)
-    image = (image - min_image) / (max_image - min_image)
+    min_image, max_image = stats["min"], stats["max"]
 
     # Verifying that image and mask have the same shape
-    image_height, image_width = image.shape
-    mask_height, mask_width = mask.shape
+    image_height, image_width = image_reader.height, image_reader.width
+    mask_height, mask_width = raster_shape(
+        os.path.join(src_path, mask_dir, img_name + ".png")
+    )
     if (image_height != mask_height) or (image_width != mask_width):
         print("Error, image and mask must have the same dimensions")
         exit(-1)
 
-    count_x = int(image_width // patch_size) + 1
-    count_y = int(image_height // patch_size) + 1
-    invalid_patches = 0
-    oil_mask_patch = 0
-    not_oil_mask_patch = 0
-    total_patches = 0
-
-    for index, (j, i) in tqdm(
-        enumerate(itertools.product(range(count_y), range(count_x)))
-    ):
-        # Get pixel positions for patch
-        y = patch_size * j
-        x = patch_size * i
+    count_x, count_y = grid_size(image_width, image_height, patch_size)
+    total_patches = count_x * count_y
 
-        # Crop whenever patch size is outside image
-        if x + patch_size > image_width:
-            x = image_width - patch_size - 1
-        if y + patch_size > image_height:
-            y = image_height - patch_size - 1
+    # Scaled patches with all values 0 (invalid SAR image patches) are the patches
+    # equal to the image minimum, not oil patches are the ones without oil pixels
+    invalid, not_oil, _ = classify_patches(
+        stats["tile_min"].ravel(),
+        stats["tile_max"].ravel(),
+        stats["oil_pixels"].ravel(),
+        patch_size,
+        invalid_value=min_image,
+    )
+    invalid_patches = int(np.count_nonzero(invalid))
+    oil_indexes = np.flatnonzero(~invalid & ~not_oil)
+    not_oil_indexes = np.flatnonzero(not_oil)
+    # Keep only the first max_not_oil_patches not oil patches
+    if max_not_oil_patches is not None:
+        not_oil_indexes = not_oil_indexes[:max_not_oil_patches]
+    oil_mask_patch = len(oil_indexes)
+    not_oil_mask_patch = len(not_oil_indexes)
 
-        image_patch = image[y : y + patch_size, x : x + patch_size]
-        total_patches = total_patches + 1
-        min_image_patch = np.min(image_patch)
-        max_image_patch = np.max(image_patch)
-        # We are checking if patch image values are 0, if so then continue next patch (we are in an invalid SAR image patch)
-        if min_image_patch == 0 and max_image_patch == 0:
-            invalid_patches = invalid_patches + 1
-            continue
-        dst_img_name = img_name + f"_{index:04d}_train.tif"
-        mask_patch = mask[y : y + patch_size, x : x + patch_size]
-        min_mask_patch = np.min(mask_patch)
-        max_mask_patch = np.max(mask_patch)
-        if min_mask_patch == 0 and max_mask_patch == 0:
-            if max_not_oil_patches is not None:
-                if max_not_oil_patches == 0:
-                    continue
-                max_not_oil_patches = max_not_oil_patches - 1
-            # Not oil patch
-            not_oil_mask_patch = not_oil_mask_patch + 1
-            # Output on not oil patches directory (for classification problem)
+    # Output on oil and not oil patches directories (for classification problem)
+    patches_dirs = dict.fromkeys(oil_indexes, oil_dir)
+    patches_dirs.update(dict.fromkeys(not_oil_indexes, not_oil_dir))
+    rows = patch_rows(patches_dirs, image_width, image_height, patch_size)
+    for y, row in tqdm(rows):
+        image_reader.prefetch_row(y, row, patch_size)
+        for index, x in row:
+            image_patch = image_reader.read_tile(x, y, patch_size)
+            image_patch = (image_patch - min_image) / (max_image - min_image)
+            dst_img_name = img_name + f"_{index:04d}_train.tif"
             imsave(
-                os.path.join(dst_path, not_oil_dir, dst_img_name),
-                image_patch,
-                check_contrast=False,
-            )
-        else:
-            # Oil patch
-            oil_mask_patch = oil_mask_patch + 1
-            # Output on oil patches directory (for classification problem)
-            imsave(
-                os.path.join(dst_path, oil_dir, dst_img_name),
+                os.path.join(dst_path, patches_dirs[index], dst_img_name),
                 image_patch,
                 check_contrast=False,
             )
+    image_reader.close()
     print(
         f"{img_name}, width, height: ({image_width}, {image_height}), total patches: {total_patches}, invalid_patches: {invalid_patches}, oil patches: {oil_mask_patch}, not oil patches: {not_oil_mask_patch}"
     )
-    return (
+    result = (
         image_width,
         image_height,
         total_patches,
@@ -123,6 +128,8 @@ def patchify_image(
         oil_mask_patch,
         not_oil_mask_patch,
     )
+    manifest.record_result(result)
+    return result
 
 
 # Create output directories
@@ -130,18 +137,25 @@ os.makedirs(dst_path, exist_ok=True)
 os.makedirs(os.path.join(dst_path, oil_dir), exist_ok=True)
 os.makedirs(os.path.join(dst_path, not_oil_dir), exist_ok=True)
 
-results = {
-    "image": [],
-    "width": [],
-    "height": [],
-    "total_patches": [],
-    "invalid_patches": [],
-    "oil_patches": [],
-    "not_oil_patches": [],
-}
-for fname in os.listdir(os.path.join(src_path, "image_tiff")):
-    width, height, total_patches, invalid_patches, oil_patches, not_oil_patches = (
-        patchify_image(
+parser = argparse.ArgumentParser(
+    prog="GenClassificationPatches", description="Generate classification patches"
+)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Scenes processed at the same time"
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Build all the scenes even when the manifest has them up to date",
+)
+args = parser.parse_args()
+print(args)
+
+fnames = os.listdir(os.path.join(src_path, "image_tiff"))
+results = map_workers(
+    patchify_image,
+    [
+        (
             src_path,
             "image_tiff",
             "mask_bin",
@@ -151,15 +165,23 @@ for fname in os.listdir(os.path.join(src_path, "image_tiff")):
             fname.split(".")[0],
             patch_size,
             120,
+            args.force,
         )
-    )
-    results["image"].append(fname)
-    results["width"].append(width)
-    results["height"].append(height)
-    results["total_patches"].append(total_patches)
-    results["invalid_patches"].append(invalid_patches)
-    results["oil_patches"].append(oil_patches)
-    results["not_oil_patches"].append(not_oil_patches)
-results_df = pd.DataFrame.from_dict(results)
+        for fname in fnames
+    ],
+    args.workers,
+)
+results_df = results_table(
+    fnames,
+    results,
+    [
+        "width",
+        "height",
+        "total_patches",
+        "invalid_patches",
+        "oil_patches",
+        "not_oil_patches",
+    ],
+)
 results_df.to_csv("results_classification.csv")
 print("Done!")
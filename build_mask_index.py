@@ -0,0 +1,56 @@
+import os
+import argparse
+
+from PIL import Image
+
+from mask_index import build_mask_index, mask_index_path
+from scene_stats import save_scene_stats
+from task_executor import map_workers
+
+# Directories configuration
+home_path = os.path.expanduser("~")
+data_path = os.path.join(home_path, "data", "cimat")
+src_path = os.path.join(data_path, "dataset-cimat")
+# Initial configuration
+mask_dir = "mask_bin"
+patch_size = 224
+
+Image.MAX_IMAGE_PIXELS = None
+
+
+def index_mask(src_path, mask_dir, img_name, patch_size):
+    index = build_mask_index(
+        os.path.join(src_path, mask_dir, img_name + ".png"), patch_size
+    )
+    save_scene_stats(mask_index_path(src_path, mask_dir, img_name), index)
+    oil_pixels = index["oil_pixels"]
+    full_patches = int((oil_pixels == patch_size * patch_size).sum())
+    empty_patches = int((oil_pixels == 0).sum())
+    print(
+        f"{mask_dir}/{img_name}, width, height: ({index['width']}, {index['height']}), runs: {len(index['run_starts'])}, empty patches: {empty_patches}, full oil patches: {full_patches}, partial patches: {oil_pixels.size - empty_patches - full_patches}"
+    )
+    return len(index["run_starts"])
+
+
+parser = argparse.ArgumentParser(
+    prog="BuildMaskIndex",
+    description="Build the run-length index (runs per row, oil pixels per patch) of every mask",
+)
+parser.add_argument("--filename", help="Only index the mask of this scene")
+parser.add_argument(
+    "--workers", type=int, default=1, help="Masks indexed at the same time"
+)
+args = parser.parse_args()
+print(args)
+
+img_names = [
+    fname.split(".")[0]
+    for fname in sorted(os.listdir(os.path.join(src_path, mask_dir)))
+    if args.filename is None or args.filename.split(".")[0] == fname.split(".")[0]
+]
+map_workers(
+    index_mask,
+    [(src_path, mask_dir, img_name, patch_size) for img_name in img_names],
+    args.workers,
+)
+print("Done!")
@@ -1,12 +1,16 @@
 import os
-import itertools
+import argparse
 import numpy as np
-import pandas as pd
 
-from skimage.io import imread, imsave
 from PIL import Image
 from tqdm import tqdm
 
+from patch_grid import band_reduce, grid_size, patch_rows
+from patch_writer import ImageSink, PatchSource, PatchWriter
+from patch_manifest import SceneManifest
+from raster_io import TileReader
+from task_executor import map_workers, results_table
+
 # Directories configuration
 home_dir = os.path.expanduser("~")
 data_dir = os.path.join(home_dir, "data", "cimat", "dataset-cimat")
@@ -19,52 +23,75 @@ patch_size = 224
 Image.MAX_IMAGE_PIXELS = None
 
 
-def patchify_image(src_path, dst_path, img_name, patch_size):
-    image = imread(os.path.join(src_path, img_name), as_gray=True)
+def patchify_image(src_path, dst_path, img_name, patch_size, force=False):
+    # Scenes already built with the current source and patch size are skipped
+    manifest = SceneManifest(
+        dst_path,
+        "masks",
+        img_name.split(".")[0],
+        [os.path.join(src_path, img_name)],
+        {"patch_size": patch_size},
+        force,
+    )
+    if manifest.result() is not None:
+        print(f"{img_name} up to date")
+        return tuple(manifest.result())
+
+    # Read the scene one band of blocks per grid row instead of loading it whole
+    image_reader = TileReader(os.path.join(src_path, img_name))
 
-    image_height, image_width = image.shape
-    count_x = int(image_width // patch_size) + 1
-    count_y = int(image_height // patch_size) + 1
+    image_height, image_width = image_reader.height, image_reader.width
+    count_x, count_y = grid_size(image_width, image_height, patch_size)
     count_0 = 0
     count_patches = 0
 
-    for index, (j, i) in tqdm(
-        enumerate(itertools.product(range(count_y), range(count_x)))
-    ):
-        y = patch_size * j
-        x = patch_size * i
-
-        if x + patch_size > image_width:
-            x = image_width - patch_size - 1
-        if y + patch_size > image_height:
-            y = image_height - patch_size - 1
-
-        dst_name = img_name.split(".")[0] + f"_{index:04d}_train.png"
-        # print(f"Image patch: {index}, i,j = ({i}, {j}), x,y = ({x}, {y})")
-        image_patch = image[y : y + patch_size, x : x + patch_size]
-        # print(f"Image patch: {image_patch.shape}")
-        min_patch = np.min(image_patch)
-        max_patch = np.max(image_patch)
-        if min_patch == 0 and max_patch == 0:
-            count_0 = count_0 + 1
-        count_patches = count_patches + 1
-        # print(f"Image patch: min: {min_patch}, max: {max_patch}")
-        # Save patch
-        imsave(os.path.join(dst_path, dst_name), image_patch, check_contrast=False)
+    # Raw patches saved through the shared patch writer, zeros are counted once per
+    # grid row with a block view reduction
+    writer = PatchWriter(
+        {"image": PatchSource(image_reader)},
+        [ImageSink("image", dst_path, ".png")],
+        patch_size,
+        img_name.split(".")[0] + "_{index:04d}_train",
+    )
+    rows = patch_rows(range(count_x * count_y), image_width, image_height, patch_size)
+    for y, row in tqdm(rows, total=count_y):
+        band = image_reader.read_rows(y, patch_size)
+        min_patches = band_reduce(band, patch_size, np.min)[0]
+        max_patches = band_reduce(band, patch_size, np.max)[0]
+        count_0 = count_0 + int(
+            np.count_nonzero((min_patches == 0) & (max_patches == 0))
+        )
+        count_patches = count_patches + len(row)
+        # Save patches
+        writer.write_row(y, row)
+    image_reader.close()
     print(
         f"{img_name}, width, height: ({image_width, image_height}), total patches: {count_patches}, patches with zeros: {count_0}"
     )
+    manifest.record_result((image_width, image_height, count_patches, count_0))
     return image_width, image_height, count_patches, count_0
 
 
-results = {"image": [], "width": [], "height": [], "patches": [], "zeros": []}
-for fname in os.listdir(src_dir):
-    width, height, patches, zeros = patchify_image(src_dir, dst_dir, fname, patch_size)
-    results["image"].append(fname)
-    results["width"].append(width)
-    results["height"].append(height)
-    results["patches"].append(patches)
-    results["zeros"].append(zeros)
-results_df = pd.DataFrame.from_dict(results)
+parser = argparse.ArgumentParser(
+    prog="GenMaskPatches", description="Generate mask patches"
+)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Scenes processed at the same time"
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Build all the scenes even when the manifest has them up to date",
+)
+args = parser.parse_args()
+print(args)
+
+fnames = os.listdir(src_dir)
+results = map_workers(
+    patchify_image,
+    [(src_dir, dst_dir, fname, patch_size, args.force) for fname in fnames],
+    args.workers,
+)
+results_df = results_table(fnames, results, ["width", "height", "patches", "zeros"])
 results_df.to_csv("results_masks.csv")
 print("Done!")
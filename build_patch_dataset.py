@@ -0,0 +1,34 @@
+import os
+import argparse
+import numpy as np
+
+from patch_dataset import pack_patch_dataset
+
+# Directories configuration
+home_path = os.path.expanduser("~")
+data_path = os.path.join(home_path, "data", "cimat")
+dst_path = os.path.join(data_path, "dataset-cimat", "segmentation")
+
+parser = argparse.ArgumentParser(
+    prog="BuildPatchDataset",
+    description="Pack the segmentation patches in memory mapped arrays for training",
+)
+parser.add_argument(
+    "--pattern", default="*", help="Patch names to pack (e.g. '*_train')"
+)
+parser.add_argument(
+    "--source",
+    choices=["files", "shards"],
+    default="files",
+    help="Read the patch files or the packed shards",
+)
+parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+parser.add_argument("--output", default=os.path.join(dst_path, "dataset"))
+args = parser.parse_args()
+print(args)
+
+patches = pack_patch_dataset(
+    dst_path, args.output, args.pattern, args.source, np.dtype(args.dtype)
+)
+print(f"Packed patches: {patches}, output: {args.output}")
+print("Done!")
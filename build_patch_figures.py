@@ -0,0 +1,108 @@
+import os
+import fnmatch
+import argparse
+import numpy as np
+
+from skimage.io import imread
+from tqdm import tqdm
+
+from patch_dataset import patch_names
+from patch_figures import figure_image, sample_patches
+from patch_shards import load_shard_index, read_shard_patches, shards_dir
+from task_executor import map_workers
+
+# Directories configuration
+home_path = os.path.expanduser("~")
+data_path = os.path.join(home_path, "data", "cimat")
+dst_path = os.path.join(data_path, "dataset-cimat", "segmentation")
+
+
+# Names of the patches whose label is all oil, read from the label files
+def full_oil_names(dst_path, names):
+    return [
+        name
+        for name in names
+        if np.all(imread(os.path.join(dst_path, "labels", name + ".png")) == 1)
+    ]
+
+
+# Save the figure (image and mask patches) of every patch given, the patches are read
+# from the files or from the shards of their index rows
+def render_figures(dst_path, figures_dir, names, index=None):
+    if index is not None:
+        out_dir = os.path.join(dst_path, shards_dir)
+        images = read_shard_patches(out_dir, os.path.join("features", "origin"), index)
+        labels = read_shard_patches(out_dir, "labels", index)
+    for i, name in enumerate(tqdm(names)):
+        if index is not None:
+            image, label = images[i], labels[i]
+        else:
+            image = imread(os.path.join(dst_path, "features", "origin", name + ".tif"))
+            label = imread(os.path.join(dst_path, "labels", name + ".png"))
+        figure = figure_image(name, [image, label], ["Image patch", "Mask patch"])
+        figure.save(os.path.join(figures_dir, name + ".png"))
+    return len(names)
+
+
+parser = argparse.ArgumentParser(
+    prog="GenPatchFigures",
+    description="Render figures of a sample of the written patches",
+)
+parser.add_argument(
+    "--input-format",
+    choices=["files", "shards"],
+    default="files",
+    help="Read the patches from a file per patch and output or from packed shards",
+)
+parser.add_argument("--pattern", default="*", help="Patch names to render")
+parser.add_argument("--every", type=int, help="Render every nth patch of each scene")
+parser.add_argument(
+    "--per-scene", type=int, help="Render k random patches of each scene"
+)
+parser.add_argument("--seed", type=int, default=0, help="Seed of the random patches")
+parser.add_argument(
+    "--full-oil", action="store_true", help="Render only the full oil patches"
+)
+parser.add_argument("--workers", type=int, default=1, help="Local worker processes")
+args = parser.parse_args()
+print(args)
+
+figures_dir = os.path.join(dst_path, "figures")
+os.makedirs(figures_dir, exist_ok=True)
+
+# Patches written, with the full oil flag from the shards index or the labels
+if args.input_format == "shards":
+    index = load_shard_index(os.path.join(dst_path, shards_dir))
+    index = index.drop_duplicates("patch_name", keep="last")
+    index = index[[fnmatch.fnmatch(name, args.pattern) for name in index["patch_name"]]]
+    if args.full_oil:
+        index = index[index["full_oil_patch"] == 1]
+    names = index["patch_name"].tolist()
+else:
+    names = patch_names(dst_path, args.pattern)
+    if args.full_oil:
+        chunks = np.array_split(np.arange(len(names)), max(args.workers, 1))
+        names = sum(
+            map_workers(
+                full_oil_names,
+                [(dst_path, [names[i] for i in chunk]) for chunk in chunks],
+                args.workers,
+            ),
+            [],
+        )
+names = sample_patches(names, args.every, args.per_scene, args.seed)
+print(f"Figures to render: {len(names)}")
+
+# Contiguous chunks of patches per worker, so every shard is read by few workers
+chunks = np.array_split(np.arange(len(names)), max(args.workers, 1))
+figures_args = []
+for chunk in chunks:
+    chunk_names = [names[i] for i in chunk]
+    if args.input_format == "shards":
+        chunk_index = index.set_index("patch_name").loc[chunk_names].reset_index()
+        figures_args.append((dst_path, figures_dir, chunk_names, chunk_index))
+    else:
+        figures_args.append((dst_path, figures_dir, chunk_names))
+rendered = map_workers(render_figures, figures_args, args.workers)
+print(f"Figures rendered: {sum(rendered)}")
+print("Done!")
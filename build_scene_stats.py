@@ -0,0 +1,57 @@
+import os
+import argparse
+
+from PIL import Image
+
+from scene_stats import compute_scene_stats, save_scene_stats, stats_path
+
+# Directories configuration
+home_path = os.path.expanduser("~")
+data_path = os.path.join(home_path, "data", "cimat")
+src_path = os.path.join(data_path, "dataset-cimat")
+# Initial configuration
+img_dirs = ["image_norm", "image_tiff", "tiff"]
+mask_dir = "mask_bin"
+txt_path = "textures"
+patch_size = 224
+
+Image.MAX_IMAGE_PIXELS = None
+
+parser = argparse.ArgumentParser(
+    prog="BuildSceneStats",
+    description="Compute the statistics sidecar (min/max, histogram, patch maps) of every scene",
+)
+parser.add_argument("--filename", help="Only compute the statistics of this scene")
+parser.add_argument("--img-dir", action="append", help="Scene directories to process")
+parser.add_argument(
+    "--textures", action="store_true", help="Also process the texture directories"
+)
+args = parser.parse_args()
+print(args)
+
+# Scene directories with the mask used for the per patch oil pixels (textures don't
+# need the mask counts)
+scene_dirs = [(img_dir, mask_dir) for img_dir in (args.img_dir or img_dirs)]
+if args.textures:
+    for texture_dir in sorted(os.listdir(os.path.join(src_path, txt_path))):
+        scene_dirs.append((os.path.join(txt_path, texture_dir), None))
+
+for img_dir, scene_mask_dir in scene_dirs:
+    if not os.path.isdir(os.path.join(src_path, img_dir)):
+        print(f"Skipping {img_dir}, directory not found")
+        continue
+    for fname in sorted(os.listdir(os.path.join(src_path, img_dir))):
+        img_name = fname.split(".")[0]
+        if args.filename is not None and args.filename.split(".")[0] != img_name:
+            continue
+        mask_path = None
+        if scene_mask_dir is not None:
+            mask_path = os.path.join(src_path, scene_mask_dir, img_name + ".png")
+        stats = compute_scene_stats(
+            os.path.join(src_path, img_dir, fname), mask_path, patch_size
+        )
+        save_scene_stats(stats_path(src_path, img_dir, img_name), stats)
+        print(
+            f"{img_dir}/{img_name}, width, height: ({stats['width']}, {stats['height']}), min: {stats['min']}, max: {stats['max']}, zero patches: {stats['zero_patches'].sum()}"
+        )
+print("Done!")
@@ -1,13 +1,27 @@
 import os
-import itertools
-import numpy as np
-import pandas as pd
+import argparse
 
-from matplotlib import pyplot as plt
-from skimage.io import imread, imsave
 from PIL import Image
 from tqdm import tqdm
 
+from patch_grid import grid_size, patch_rows
+from mask_index import has_mask_index, open_mask
+from patch_manifest import SceneManifest
+from patch_writer import (
+    FigureSink,
+    ImageSink,
+    PatchSource,
+    PatchWriter,
+    PreviewSink,
+    binary_mask,
+    scaler,
+)
+from patch_shards import ShardSink, shards_dir
+from raster_io import SharedBand, TileReader
+from scene_stats import scene_min_max
+from task_executor import map_workers, slurm_task, task_scenes
+from work_queue import WorkQueue, queue_path, static_patches, task_owner
+
 # Directories configuration
 home_path = os.path.expanduser("~")
 data_path = os.path.join(home_path, "data", "cimat")
@@ -38,6 +52,14 @@ def patchify_image(
     dst_path,
     img_name,
     patch_size,
+    output_format="files",
+    schedule="static",
+    range_size=16,
+    ntasks=1,
+    procid=0,
+    shared_mask=None,
+    force=False,
+    figures=False,
 ):
     print(
         src_path,
@@ -46,112 +68,200 @@ def patchify_image(
         dst_path,
         img_name,
         patch_size,
+        output_format,
+        schedule,
+        procid,
     )
     # In this case we are opening both image and mask to patchify at the same time
     # considering that we are removing outside regions pixels (SAR image) and separating
-    # oil from not oil spill patches
-    image = imread(os.path.join(src_path, img_dir, img_name + ".tif"), as_gray=True)
-    mask = imread(os.path.join(src_path, mask_dir, img_name + ".png"), as_gray=True)
-    # Scale image between 0 and 1
-    min_image = np.min(image)
-    max_image = np.max(image)
-    image_scaled = (image - min_image) / (max_image - min_image)
-    # Mark all pixels on the mask above 0 as oil
-    mask[mask > 0] = 1
+    # oil from not oil spill patches. Only the windows of the patches assigned to this
+    # task are read from disk, the readers are kept open for all the ranges of patches
+    # the task gets from the queue
+    image_reader = TileReader(os.path.join(src_path, img_dir, img_name + ".tif"))
+    # The mask is read from shared memory when it is decoded once for all the workers,
+    # otherwise from its run-length index when built (no decoding) or the PNG
+    if shared_mask is not None:
+        mask_reader = shared_mask.reader()
+    else:
+        mask_reader = open_mask(src_path, mask_dir, img_name, patch_size)
+    # Scale image between 0 and 1 (global min/max from the scene statistics sidecar)
+    min_image, max_image = scene_min_max(src_path, img_dir, img_name, image_reader)
 
     # Verifying that image and mask have the same shape
-    image_height, image_width = image.shape
-    mask_height, mask_width = mask.shape
+    image_height, image_width = image_reader.height, image_reader.width
+    mask_height, mask_width = mask_reader.height, mask_reader.width
     if (image_height != mask_height) or (image_width != mask_width):
         print("Error, image and mask must have the same dimensions")
         exit(-1)
 
-    count_x = int(image_width // patch_size) + 1
-    count_y = int(image_height // patch_size) + 1
+    count_x, count_y = grid_size(image_width, image_height, patch_size)
+
+    # Tiles already written with the current image, mask and options
+    manifest = SceneManifest(
+        dst_path,
+        "segmentation",
+        img_name,
+        [image_reader.path, os.path.join(src_path, mask_dir, img_name + ".png")],
+        {"patch_size": patch_size, "output_format": output_format, "figures": figures},
+        force,
+    )
+    done_tiles = manifest.done_tiles()
+    part = f"{procid:03d}"
 
     total_patches = count_x * count_y
-    patches_per_task = total_patches // int(slurm_ntasks)
-    missing_patches_per_task = total_patches % int(slurm_ntasks)
-
-    patches_indexes = [
-        int(slurm_procid) * patches_per_task + index
-        for index in range(patches_per_task)
-    ]
-    if int(slurm_procid) < missing_patches_per_task:
-        additional_index = int(slurm_ntasks) * patches_per_task + int(slurm_procid)
-        patches_indexes.append(additional_index)
-
-    print("Patches indexes: ", patches_indexes)
-
-    # Build patchex indexes to process considering the max patches, ntasks and task process id
-    patches_positions = list(itertools.product(range(count_y), range(count_x)))
-    for patch_index in patches_indexes:
-        j, i = patches_positions[patch_index]
-
-        print("Processing patch index: ", patch_index, i, j)
-        # Get pixel positions for patch
-        y = patch_size * j
-        x = patch_size * i
-
-        # Crop whenever patch size is outside image
-        if x + patch_size > image_width:
-            x = image_width - patch_size - 1
-        if y + patch_size > image_height:
-            y = image_height - patch_size - 1
-
-        # Original image patch
-        image_patch = image[y : y + patch_size, x : x + patch_size]
-        # Scaled image patch
-        image_scaled_patch = image_scaled[y : y + patch_size, x : x + patch_size]
-        total_patches = total_patches + 1
-        min_image_patch = np.min(image_patch)
-        max_image_patch = np.max(image_patch)
-        # We are checking if patch image values are 0, if so then continue next patch (we are in an invalid SAR image patch)
-        # if min_image_patch == 0 and max_image_patch == 0:
-        #    invalid_patches = invalid_patches + 1
-        #    continue
-        dst_img_name = img_name + f"_{patch_index:04d}_train"
-        mask_patch = mask[y : y + patch_size, x : x + patch_size]
-
-        imsave(
-            os.path.join(dst_path, "features", "origin", dst_img_name + ".tif"),
-            image_scaled_patch,
-            check_contrast=False,
+    if schedule == "queue":
+        # Ranges of patches handed out on demand to the tasks working on the scene
+        work_queue = WorkQueue(queue_path(dst_path, "segmentation", img_name))
+        work_queue.add(img_name, total_patches, range_size)
+        patches_ranges = (
+            (f"range_{start:06d}", range(start, stop), rowid)
+            for rowid, _, start, stop in work_queue.ranges(task_owner(procid))
         )
-        # Save in png for visualization
-        image_to_save = Image.fromarray((image_scaled_patch * 255).astype(np.int16))
-        image_to_save.save(os.path.join(dst_path, "images", dst_img_name + ".png"))
-        imsave(
-            os.path.join(dst_path, "labels", dst_img_name + ".png"),
-            mask_patch,
-            check_contrast=False,
-        )
-        # Save figure with image and mask patches
-        fig, ax = plt.subplots(1, 2, figsize=(12, 8))
-        ax[0].imshow(image_scaled_patch, cmap="gray")
-        ax[0].set_title("Image patch")
-        ax[1].imshow(mask_patch, cmap="gray")
-        ax[1].set_title("Mask patch")
-        fig.tight_layout()
-        fig.suptitle(dst_img_name)
-        plt.savefig(os.path.join(dst_path, "figures", dst_img_name + ".png"))
-        plt.close()
+    else:
+        patches_ranges = [(part, static_patches(total_patches, ntasks, procid), None)]
+        if output_format == "shards" and done_tiles.issuperset(patches_ranges[0][1]):
+            print("Patches of the task up to date")
+            image_reader.close()
+            mask_reader.close()
+            return
+
+    # Traverse the patches of this task grouped by grid row, reading one band of blocks
+    # per row for the image and the mask, every patch is read once and saved to all
+    # the outputs
+    sources = {
+        "image": PatchSource(image_reader, scaler(min_image, max_image)),
+        "mask": PatchSource(mask_reader, binary_mask),
+    }
+    sinks = []
+    if output_format == "files":
+        sinks = [
+            ImageSink("image", os.path.join(dst_path, "features", "origin")),
+            PreviewSink("image", os.path.join(dst_path, "images")),
+            ImageSink("mask", os.path.join(dst_path, "labels"), ".png"),
+        ]
+    if figures:
+        # Figures are rendered afterwards by build_patch_figures.py unless asked for
+        sinks.append(FigureSink(os.path.join(dst_path, "figures")))
+    name_format = img_name + "_{index:04d}_train"
+    writer = PatchWriter(sources, sinks, patch_size, name_format)
+    for shards_part, patches_indexes, rowid in patches_ranges:
+        print("Patches indexes: ", list(patches_indexes))
+        if output_format == "shards" and done_tiles.issuperset(patches_indexes):
+            # Range of the queue already saved on the shards of a previous run
+            print("Patches of the range up to date")
+        elif output_format == "shards":
+            # Packed patches and index instead of a file per patch and output. The
+            # patches of the task (or of the range of the queue) are saved again as
+            # a whole on their own shards, closed and recorded before the range is
+            # completed so a killed task keeps the ranges it already saved
+            shard_sink = ShardSink(
+                os.path.join(dst_path, shards_dir),
+                f"{img_name}_{shards_part}",
+                img_name,
+                {"image": os.path.join("features", "origin"), "mask": "labels"},
+            )
+            PatchWriter(sources, sinks + [shard_sink], patch_size, name_format).write(
+                patches_indexes, image_width, image_height
+            )
+            shard_sink.close()
+            manifest.record_tiles(part, patches_indexes)
+        else:
+            # Only the missing or stale patch files are written, every grid row is
+            # recorded once saved so a killed task resumes from it
+            pending_indexes = [
+                index for index in patches_indexes if index not in done_tiles
+            ]
+            rows = patch_rows(pending_indexes, image_width, image_height, patch_size)
+            for y, row in tqdm(rows):
+                writer.write_row(y, row)
+                manifest.record_tiles(part, [index for index, _ in row])
+        if rowid is not None:
+            work_queue.complete(rowid)
+    writer.close()
+    if schedule == "queue":
+        work_queue.close()
 
 
+parser = argparse.ArgumentParser(
+    prog="GenSegmentationPatches", description="Generate segmentation patches"
+)
+parser.add_argument(
+    "--output-format",
+    choices=["files", "shards"],
+    default="files",
+    help="Save a file per patch and output or packed shards with an index",
+)
+parser.add_argument(
+    "--schedule",
+    choices=["static", "queue"],
+    default="static",
+    help="Split the patches evenly between the tasks or hand out ranges of patches "
+    "on demand from a queue shared by the tasks",
+)
+parser.add_argument(
+    "--range-size", type=int, default=16, help="Patches of every range of the queue"
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Local worker processes of every task, sharing the decoded mask",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Write all the patches even when the manifest has them up to date",
+)
+parser.add_argument(
+    "--figures",
+    action="store_true",
+    help="Save a figure of every patch written, build_patch_figures.py renders a "
+    "sample of them as a separate stage",
+)
+args = parser.parse_args()
+print(args)
+
 # Create output directories
 os.makedirs(dst_path, exist_ok=True)
 os.makedirs(os.path.join(dst_path, "features", "origin"), exist_ok=True)
 os.makedirs(os.path.join(dst_path, "images"), exist_ok=True)
 os.makedirs(os.path.join(dst_path, "labels"), exist_ok=True)
-os.makedirs(os.path.join(dst_path, "figures"), exist_ok=True)
 
-fname = os.listdir(os.path.join(src_path, "image_norm"))[int(slurm_array_task_id) - 1]
-patchify_image(
-    src_path,
-    "image_norm",
-    "mask_bin",
-    dst_path,
-    fname.split(".")[0],
-    patch_size,
-)
+# Every SLURM task runs as many local workers, each one as a task of its own
+ntasks, procid = slurm_task()
+for fname in task_scenes(os.path.join(src_path, "image_norm")):
+    img_name = fname.split(".")[0]
+    shared_mask = None
+    # Without a mask index every worker would decode the whole mask again
+    if args.workers > 1 and not has_mask_index(
+        src_path, "mask_bin", img_name, patch_size
+    ):
+        shared_mask = SharedBand(os.path.join(src_path, "mask_bin", img_name + ".png"))
+    try:
+        map_workers(
+            patchify_image,
+            [
+                (
+                    src_path,
+                    "image_norm",
+                    "mask_bin",
+                    dst_path,
+                    img_name,
+                    patch_size,
+                    args.output_format,
+                    args.schedule,
+                    args.range_size,
+                    ntasks * args.workers,
+                    procid * args.workers + worker,
+                    shared_mask,
+                    args.force,
+                    args.figures,
+                )
+                for worker in range(args.workers)
+            ],
+            args.workers,
+        )
+    finally:
+        if shared_mask is not None:
+            shared_mask.unlink()
 print("Done!")
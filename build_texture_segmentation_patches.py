@@ -1,14 +1,27 @@
 import os
-import rasterio
 import argparse
-import itertools
 import numpy as np
 import pandas as pd
+import rasterio
 
-from matplotlib import pyplot as plt
-from skimage.io import imread, imsave
 from PIL import Image
-from tqdm import tqdm
+
+from patch_grid import classify_patches, grid_size
+from patch_writer import (
+    BandsSink,
+    FigureSink,
+    ImageSink,
+    PatchSource,
+    PatchWriter,
+    PreviewSink,
+    binary_mask,
+    scaler,
+)
+from patch_shards import ShardSink, shards_dir
+from mask_index import open_mask
+from patch_manifest import SceneManifest
+from raster_io import TileReader, iter_row_windows
+from scene_stats import get_scene_stats, scene_min_max
 
 # Directories configuration
 home_path = os.path.expanduser("~")
@@ -17,10 +30,57 @@ src_path = os.path.join(data_path, "dataset-cimat")
 dst_path = os.path.join(data_path, "dataset-cimat", "segmentation")
 # Initial configuration
 patch_size = 224
+stack_dir = "textures_stack"
 
 Image.MAX_IMAGE_PIXELS = None
 
 
+# Multi-band stack of a scene (textures_stack/<scene>.tif): the scaled image and
+# every scaled texture as the bands of a tiled GeoTIFF with blocks of the patch size,
+# so all the layers of a patch come from a single read. It is written again when a
+# layer was modified after it or the layers changed
+def texture_stack(src_path, layers, img_name, patch_size):
+    stack_path = os.path.join(src_path, stack_dir, img_name + ".tif")
+    names = [name for name, _, _ in layers]
+    if os.path.exists(stack_path) and all(
+        os.path.getmtime(stack_path) >= os.path.getmtime(reader.path)
+        for _, reader, _ in layers
+    ):
+        with rasterio.open(stack_path) as dataset:
+            if list(dataset.descriptions) == names:
+                return stack_path
+    print(f"Building the texture stack of {img_name}")
+    os.makedirs(os.path.dirname(stack_path), exist_ok=True)
+    _, image_reader, _ = layers[0]
+    for name, reader, _ in layers:
+        if reader.height != image_reader.height or reader.width != image_reader.width:
+            print(f"Error, layer {name} and image must have the same dimensions")
+            exit(-1)
+    tmp_path = stack_path + ".tmp"
+    with rasterio.open(
+        tmp_path,
+        "w",
+        driver="GTiff",
+        width=image_reader.width,
+        height=image_reader.height,
+        count=len(layers),
+        dtype="float32",
+        tiled=True,
+        blockxsize=patch_size,
+        blockysize=patch_size,
+        compress="deflate",
+        interleave="pixel",
+        bigtiff="if_safer",
+    ) as dataset:
+        for band, (name, reader, scale) in enumerate(layers, start=1):
+            dataset.set_band_description(band, name)
+            for window in iter_row_windows(dataset, band, patch_size * 4):
+                rows = reader.read_rows(window.row_off, window.height)
+                dataset.write(scale(rows), band, window=window)
+    os.replace(tmp_path, stack_path)
+    return stack_path
+
+
 def patchify_image(
     src_path,
     img_dir,
@@ -29,6 +89,10 @@ def patchify_image(
     txt_path,
     img_name,
     patch_size,
+    output_format="files",
+    force=False,
+    figures=False,
+    stack=False,
 ):
     print(
         src_path,
@@ -38,184 +102,157 @@ def patchify_image(
         txt_path,
         img_name,
         patch_size,
+        output_format,
     )
+    # Scenes already built with the current image, mask, textures and options are
+    # skipped
+    texture_dirs = os.listdir(os.path.join(src_path, txt_path))
+    manifest = SceneManifest(
+        dst_path,
+        "texture",
+        img_name,
+        [
+            os.path.join(src_path, img_dir, img_name + ".tif"),
+            os.path.join(src_path, mask_dir, img_name + ".png"),
+        ]
+        + [
+            os.path.join(src_path, txt_path, texture_dir, img_name + ".tif")
+            for texture_dir in texture_dirs
+        ],
+        {
+            "patch_size": patch_size,
+            "output_format": output_format,
+            "stack": stack,
+            "figures": figures,
+        },
+        force,
+    )
+    if manifest.result() is not None:
+        print(f"{img_name} up to date")
+        return tuple(manifest.result())
     # In this case we are opening both image and mask to patchify at the same time
     # considering that we are removing outside regions pixels (SAR image) and separating
-    # oil from not oil spill patches
-    image = rasterio.open(os.path.join(src_path, img_dir, img_name + ".tif")).read(1)
-    mask = imread(
-        os.path.join(src_path, mask_dir, img_name + ".png"), as_gray=True
-    ).astype(np.uint8)
-    print("Mask: ", mask.min(), mask.max(), mask.shape, mask.dtype)
-    mask[mask > 0] = 1
-    print("Mask: ", mask.min(), mask.max(), mask.shape, mask.dtype)
+    # oil from not oil spill patches. The patches to save are selected from the scene
+    # statistics sidecar and only those are read, by windows
+    stats = get_scene_stats(src_path, img_dir, img_name, patch_size, mask_dir)
+    image_reader = TileReader(os.path.join(src_path, img_dir, img_name + ".tif"))
+    mask_reader = open_mask(src_path, mask_dir, img_name, patch_size)
     # Scale image between 0 and 1
-    min_image = np.min(image)
-    max_image = np.max(image)
-    image_scaled = (image - min_image) / (max_image - min_image)
-    # Mark all pixels on the mask above 0 as oil
+    min_image, max_image = stats["min"], stats["max"]
 
     # Verifying that image and mask have the same shape
-    image_height, image_width = image.shape
-    mask_height, mask_width = mask.shape
+    image_height, image_width = image_reader.height, image_reader.width
+    mask_height, mask_width = mask_reader.height, mask_reader.width
     if (image_height != mask_height) or (image_width != mask_width):
         print("Error, image and mask must have the same dimensions")
         print("Image dimensions: ", image_height, image_width)
         print("Mask dimensions: ", mask_height, mask_width)
         exit(-1)
 
-    count_x = int(image_width // patch_size) + 1
-    count_y = int(image_height // patch_size) + 1
-    invalid_patches = 0
-    total_patches = 0
-    oil_patches = 0
-    full_oil_patches = 0
-    empty_oil_patches = 0
-    pixels_oil = 0
-
-    for index, (j, i) in tqdm(
-        enumerate(itertools.product(range(count_y), range(count_x)))
-    ):
-        # Get pixel positions for patch
-        y = patch_size * j
-        x = patch_size * i
-
-        # Crop whenever patch size is outside image
-        if x + patch_size > image_width:
-            x = image_width - patch_size - 1
-        if y + patch_size > image_height:
-            y = image_height - patch_size - 1
-
-        # Original image patch
-        image_patch = image[y : y + patch_size, x : x + patch_size]
-        # Scaled image patch
-        image_scaled_patch = image_scaled[y : y + patch_size, x : x + patch_size]
-        total_patches = total_patches + 1
-        min_image_patch = np.min(image_patch)
-        max_image_patch = np.max(image_patch)
-        # We are checking if patch image values are 0, if so then continue next patch
-        # (we are in an invalid SAR image patch)
-        if min_image_patch == 0 and max_image_patch == 0:
-            invalid_patches = invalid_patches + 1
-            continue
-        dst_img_name = img_name + f"_{index:04d}"
-        mask_patch = mask[y : y + patch_size, x : x + patch_size]
-        min_mask_patch = np.min(mask_patch)
-        max_mask_patch = np.max(mask_patch)
-        if min_mask_patch == 1 and max_mask_patch == 1:
-            # Full oil patch
-            full_oil_patches = full_oil_patches + 1
-        if min_mask_patch == 0 and max_mask_patch == 0:
-            # Empty oil patch
-            empty_oil_patches = empty_oil_patches + 1
-            continue
-
-        # Count how many pixels in the mask are equal to 1
-        pixels_oil += np.sum(mask_patch)
-        # We are only saving patches with at least some content of oil
-        oil_patches = oil_patches + 1
-        imsave(
-            os.path.join(dst_path, "features", "origin", dst_img_name + ".tif"),
-            image_scaled_patch,
-            check_contrast=False,
-        )
-        # Save in png for visualization
-        image_to_save = Image.fromarray((image_scaled_patch * 255).astype(np.int16))
-        image_to_save.save(os.path.join(dst_path, "images", dst_img_name + ".png"))
-        imsave(
-            os.path.join(dst_path, "labels", dst_img_name + ".png"),
-            mask_patch,
-            check_contrast=False,
-        )
-        # Save figure with image and mask patches
-        fig, ax = plt.subplots(1, 2, figsize=(12, 8))
-        ax[0].imshow(image_scaled_patch, cmap="gray")
-        ax[0].set_title("Image patch")
-        ax[1].imshow(mask_patch, cmap="gray")
-        ax[1].set_title("Mask patch")
-        fig.tight_layout()
-        fig.suptitle(dst_img_name)
-        plt.savefig(os.path.join(dst_path, "figures", "images", img_name + ".png"))
-        plt.close()
-    # Calculate percentage of pixel oils
-    total_pixels = oil_patches * patch_size * patch_size
-    percentage_pixels_oil = round(pixels_oil / total_pixels * 100, 2)
-    print(
-        f"{img_name}, width, height: ({image_width}, {image_height}), total patches: {total_patches}, invalid_patches: {invalid_patches}, oil patches: {oil_patches}, full oil patches: {full_oil_patches}, empty oil patches: {empty_oil_patches}, total pixels: {total_pixels}, pixels oil: {pixels_oil}, percentage pixels_oil: {percentage_pixels_oil}"
+    count_x, count_y = grid_size(image_width, image_height, patch_size)
+    total_patches = count_x * count_y
+    # We are checking if patch image values are 0 (we are in an invalid SAR image
+    # patch), full oil and empty oil patches
+    oil_pixels = stats["oil_pixels"].ravel()
+    invalid, empty, full = classify_patches(
+        stats["tile_min"].ravel(), stats["tile_max"].ravel(), oil_pixels, patch_size
     )
-    # Now traverse texture directories
-    for texture_dir in os.listdir(os.path.join(src_path, txt_path)):
-        print(f"Texture: {texture_dir}")
+    invalid_patches = int(np.count_nonzero(invalid))
+    full_oil_patches = int(np.count_nonzero(full))
+    empty_oil_patches = int(np.count_nonzero(empty))
+    # We are only saving patches with at least some content of oil
+    oil_indexes = np.flatnonzero(~invalid & ~empty)
+    oil_patches = len(oil_indexes)
+    # Count how many pixels in the mask are equal to 1
+    pixels_oil = oil_pixels[oil_indexes].sum()
+
+    # Image, mask and every texture are written in a single traversal of the kept
+    # patches
+    sources = {
+        "image": PatchSource(image_reader, scaler(min_image, max_image)),
+        "mask": PatchSource(mask_reader, binary_mask),
+    }
+    layer_dirs = {"image": os.path.join("features", "origin"), "mask": "labels"}
+    sinks = []
+    if figures:
+        # A figure of every patch, build_patch_figures.py renders a sample of them
+        # as a separate stage
+        sinks.append(FigureSink(os.path.join(dst_path, "figures", "images")))
+    if output_format == "files":
+        sinks += [
+            ImageSink("image", os.path.join(dst_path, "features", "origin")),
+            PreviewSink("image", os.path.join(dst_path, "images")),
+            ImageSink("mask", os.path.join(dst_path, "labels"), ".png"),
+        ]
+    layers = [("image", image_reader, sources["image"].transform)]
+    for texture_dir in texture_dirs:
         # Open texture image
-        texture_image = rasterio.open(
+        texture_reader = TileReader(
             os.path.join(src_path, txt_path, texture_dir, img_name + ".tif")
-        ).read(1)
+        )
         # Scale texture_image between 0 and 1
-        texture_image_scaled = (texture_image - texture_image.min()) / (
-            texture_image.max() - texture_image.min()
+        min_texture, max_texture = scene_min_max(
+            src_path, os.path.join(txt_path, texture_dir), img_name, texture_reader
         )
-
-        # Verifying that image and mask have the same shape
-        texture_image_height, texture_image_width = texture_image.shape
-        # if (texture_image_height != mask_height) or (texture_image_width != mask_width):
+        # if (texture_reader.height != mask_height) or (texture_reader.width != mask_width):
         #    print(
         #        f"Error, texture image {texture_dir} and mask must have the same dimensions"
         #    )
-        #    print("Texture dimensions: ", texture_image_height, texture_image_width)
+        #    print("Texture dimensions: ", texture_reader.height, texture_reader.width)
         #    print("Mask dimensions: ", mask_height, mask_width)
         #    exit(-1)
-
-        for index, (j, i) in tqdm(
-            enumerate(itertools.product(range(count_y), range(count_x)))
-        ):
-            # Get pixel positions for patch
-            y = patch_size * j
-            x = patch_size * i
-
-            # Crop whenever patch size is outside image
-            if x + patch_size > image_width:
-                x = image_width - patch_size - 1
-            if y + patch_size > image_height:
-                y = image_height - patch_size - 1
-
-            # Original image patch
-            image_patch = image[y : y + patch_size, x : x + patch_size]
-            # Scaled image patch
-            texture_image_scaled_patch = texture_image_scaled[
-                y : y + patch_size, x : x + patch_size
-            ]
-            min_image_patch = np.min(image_patch)
-            max_image_patch = np.max(image_patch)
-            # We are checking if patch image values are 0, if so then continue next patch
-            # (we are in an invalid SAR image patch)
-            if min_image_patch == 0 and max_image_patch == 0:
-                continue
-            dst_img_name = img_name + f"_{index:04d}"
-            mask_patch = mask[y : y + patch_size, x : x + patch_size]
-            min_mask_patch = np.min(mask_patch)
-            max_mask_patch = np.max(mask_patch)
-            if min_mask_patch == 1 and max_mask_patch == 1:
-                # Full oil patch
-                pass
-            if min_mask_patch == 0 and max_mask_patch == 0:
-                # Empty oil patch
-                continue
-
-            # Count how many pixels in the mask are equal to 1
-            # We are only saving patches with at least some content of oil
-            os.makedirs(
-                os.path.join(dst_path, "features", "texture", texture_dir),
-                exist_ok=True,
+        print(f"Texture: {texture_dir}")
+        layers.append((texture_dir, texture_reader, scaler(min_texture, max_texture)))
+        if stack:
+            continue
+        sources["texture/" + texture_dir] = PatchSource(
+            texture_reader, scaler(min_texture, max_texture)
+        )
+        layer_dirs["texture/" + texture_dir] = os.path.join(
+            "features", "texture", texture_dir
+        )
+        if output_format == "files":
+            sinks.append(
+                ImageSink(
+                    "texture/" + texture_dir,
+                    os.path.join(dst_path, "features", "texture", texture_dir),
+                )
+            )
+    if stack:
+        # A (layers, patch_size, patch_size) patch per tile from the stack instead of
+        # a file per texture, the image layer is sliced from the same read
+        stack_reader = TileReader(
+            texture_stack(src_path, layers, img_name, patch_size),
+            list(range(1, len(layers) + 1)),
+        )
+        for _, reader, _ in layers:
+            reader.close()
+        sources["image"] = PatchSource(stack_reader, lambda patch: patch[0])
+        sources["stack"] = PatchSource(stack_reader)
+        layer_dirs["stack"] = os.path.join("features", stack_dir)
+        if output_format == "files":
+            sinks.append(
+                BandsSink("stack", os.path.join(dst_path, "features", stack_dir))
             )
-            imsave(
-                os.path.join(
-                    dst_path, "features", "texture", texture_dir, dst_img_name + ".tif"
-                ),
-                texture_image_scaled_patch,
-                check_contrast=False,
+    if output_format == "shards":
+        # Packed patches of all the layers and index instead of a file per patch
+        sinks.append(
+            ShardSink(
+                os.path.join(dst_path, shards_dir), img_name, img_name, layer_dirs
             )
+        )
+    writer = PatchWriter(sources, sinks, patch_size, img_name + "_{index:04d}")
+    writer.write(oil_indexes, image_width, image_height)
+    writer.close()
+
+    # Calculate percentage of pixel oils
+    total_pixels = oil_patches * patch_size * patch_size
+    percentage_pixels_oil = round(pixels_oil / total_pixels * 100, 2)
+    print(
+        f"{img_name}, width, height: ({image_width}, {image_height}), total patches: {total_patches}, invalid_patches: {invalid_patches}, oil patches: {oil_patches}, full oil patches: {full_oil_patches}, empty oil patches: {empty_oil_patches}, total pixels: {total_pixels}, pixels oil: {pixels_oil}, percentage pixels_oil: {percentage_pixels_oil}"
+    )
 
-    return (
+    result = (
         image_width,
         image_height,
         total_patches,
@@ -227,12 +264,36 @@ def patchify_image(
         pixels_oil,
         percentage_pixels_oil,
     )
+    manifest.record_result(result)
+    return result
 
 
 parser = argparse.ArgumentParser(
     prog="GenTexturePatches", description="Generate texture patches"
 )
 parser.add_argument("--filename")
+parser.add_argument(
+    "--output-format",
+    choices=["files", "shards"],
+    default="files",
+    help="Save a file per patch and output or packed shards with an index",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Build the scene even when the manifest has it up to date",
+)
+parser.add_argument(
+    "--figures",
+    action="store_true",
+    help="Save a figure of every patch written",
+)
+parser.add_argument(
+    "--stack",
+    action="store_true",
+    help="Save the image and all the textures of every patch as a single "
+    "multi-band patch, read from a tiled stack of the scene",
+)
 args = parser.parse_args()
 print(args)
 
@@ -242,7 +303,6 @@ os.makedirs(os.path.join(dst_path, "features", "origin"), exist_ok=True)
 os.makedirs(os.path.join(dst_path, "images"), exist_ok=True)
 os.makedirs(os.path.join(dst_path, "labels"), exist_ok=True)
 os.makedirs(os.path.join(dst_path, "figures"), exist_ok=True)
-os.makedirs(os.path.join(dst_path, "figures", "images"), exist_ok=True)
 os.makedirs(os.path.join(dst_path, "figures", "texture"), exist_ok=True)
 
 fname = args.filename
@@ -254,5 +314,9 @@ patchify_image(
     "textures",
     fname.split(".")[0],
     patch_size,
+    args.output_format,
+    args.force,
+    args.figures,
+    args.stack,
 )
 print("Done!")
@@ -0,0 +1,107 @@
+import os
+import argparse
+import pandas as pd
+
+from rasterio.errors import RasterioIOError
+
+from patch_dataset import scan_patches
+from patch_figures import patch_name_pattern
+from raster_io import raster_shape
+from task_executor import map_workers
+
+# Directories configuration
+home_path = os.path.expanduser("~")
+data_path = os.path.join(home_path, "data", "cimat")
+dst_path = os.path.join(data_path, "dataset-cimat", "segmentation")
+patch_size = 224
+
+
+# Problems of the patches of a scene: the labels and textures missing for an origin
+# patch or without one (extra), from the differences of the sets of names, and the
+# patches of every layer whose width or height isn't patch_size or that can't be read
+# (from the headers only, with rasterio so the float64 patches are read too). The
+# textures are only written for the patches of the texture builder
+# ({scene}_{index}), not for the segmentation or augmented ones
+def check_scene(scene, layers, patch_size, check_sizes=True):
+    problems = []
+    origin = layers["origin"]
+    texture_origin = set()
+    for name in origin:
+        match = patch_name_pattern.match(name)
+        if match and not match.group("train") and not match.group("aug"):
+            texture_origin.add(name)
+    for layer, patches in layers.items():
+        if layer == "origin":
+            continue
+        expected = texture_origin if layer.startswith("texture/") else origin
+        for name in sorted(expected - patches.keys()):
+            problems.append((scene, layer, name, "missing", ""))
+        for name in sorted(patches.keys() - expected):
+            problems.append((scene, layer, name, "extra", ""))
+    if check_sizes:
+        for layer, patches in layers.items():
+            for name, path in sorted(patches.items()):
+                try:
+                    height, width = raster_shape(path)
+                except RasterioIOError as error:
+                    problems.append((scene, layer, name, "unreadable", str(error)))
+                    continue
+                if width != patch_size or height != patch_size:
+                    problems.append((scene, layer, name, "size", f"{width}x{height}"))
+    return problems
+
+
+parser = argparse.ArgumentParser(
+    prog="CheckPatches",
+    description="Verify that every patch has its label and textures with the same size",
+)
+parser.add_argument(
+    "--skip-sizes",
+    action="store_true",
+    help="Only compare the names, without reading the headers of the patches",
+)
+parser.add_argument("--workers", type=int, default=1, help="Local worker processes")
+args = parser.parse_args()
+print(args)
+
+# Every directory is scanned once, the patches are then grouped by scene
+layer_dirs = {
+    "origin": (os.path.join(dst_path, "features", "origin"), ".tif"),
+    "labels": (os.path.join(dst_path, "labels"), ".png"),
+}
+texture_path = os.path.join(dst_path, "features", "texture")
+if os.path.isdir(texture_path):
+    for texture_dir in sorted(os.listdir(texture_path)):
+        layer_dirs["texture/" + texture_dir] = (
+            os.path.join(texture_path, texture_dir),
+            ".tif",
+        )
+scenes = {}
+for layer, (layer_dir, extension) in layer_dirs.items():
+    patches = scan_patches(layer_dir, extension=extension)
+    print(f"{layer}: {len(patches)} patches")
+    for name, path in patches.items():
+        match = patch_name_pattern.match(name)
+        scene = match.group("scene") if match else "(other names)"
+        scene_layers = scenes.setdefault(scene, {key: {} for key in layer_dirs})
+        scene_layers[layer][name] = path
+
+scene_names = sorted(scenes)
+results = map_workers(
+    check_scene,
+    [(scene, scenes[scene], patch_size, not args.skip_sizes) for scene in scene_names],
+    args.workers,
+)
+problems = pd.DataFrame(
+    [problem for result in results for problem in result],
+    columns=["scene", "layer", "patch_name", "problem", "detail"],
+)
+for scene in scene_names:
+    counts = problems[problems["scene"] == scene]["problem"].value_counts()
+    status = ", ".join(f"{problem}: {count}" for problem, count in counts.items())
+    print(f"{scene}: {len(scenes[scene]['origin'])} patches, {status or 'ok'}")
+problems.to_csv("results_check_patches.csv", index=False)
+if len(problems):
+    print(f"Error, {len(problems)} problems found, see results_check_patches.csv")
+    exit(-1)
+print("Done!")
@@ -0,0 +1,93 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+
+from PIL import Image
+
+from raster_io import iter_row_windows
+from task_executor import map_workers
+
+base_path = os.path.expanduser("~")
+data_path = os.path.join(base_path, "data", "cimat", "dataset-cimat")
+# Distinct values listed per raster, beyond them only min and max are reported
+max_values = 16
+
+Image.MAX_IMAGE_PIXELS = None
+
+
+# Shape, bands, dtype and layout of a raster read from its header only and, with
+# stats, its min, max and distinct values (integer rasters) streamed by row bands
+def inspect_raster(path, stats=False):
+    with rasterio.open(path) as dataset:
+        block_height, block_width = dataset.block_shapes[0]
+        report = {
+            "path": path,
+            "width": dataset.width,
+            "height": dataset.height,
+            "bands": dataset.count,
+            "dtype": dataset.dtypes[0],
+            "nbits": dataset.tags(1, "IMAGE_STRUCTURE").get("NBITS", ""),
+            "block": f"{block_width}x{block_height}",
+            "compression": dataset.compression.value if dataset.compression else "",
+        }
+        if not stats:
+            return report
+        min_value, max_value = None, None
+        values = set()
+        integer = np.issubdtype(np.dtype(dataset.dtypes[0]), np.integer)
+        for window in iter_row_windows(dataset):
+            data = dataset.read(window=window)
+            min_data, max_data = data.min(), data.max()
+            min_value = min_data if min_value is None else min(min_value, min_data)
+            max_value = max_data if max_value is None else max(max_value, max_data)
+            if integer and len(values) <= max_values:
+                values.update(np.unique(data).tolist())
+        report["min"] = min_value
+        report["max"] = max_value
+        report["values"] = (
+            " ".join(str(value) for value in sorted(values))
+            if integer and len(values) <= max_values
+            else ""
+        )
+        return report
+
+
+parser = argparse.ArgumentParser(
+    prog="CheckRasters",
+    description="Report the shape, bands and dtype of the rasters from their headers",
+)
+parser.add_argument(
+    "--dir",
+    action="append",
+    help="Directories of the dataset to inspect (mask_png and mask_bin by default)",
+)
+parser.add_argument(
+    "--stats",
+    action="store_true",
+    help="Also compute min, max and distinct values, streaming every raster",
+)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Rasters inspected at the same time"
+)
+parser.add_argument(
+    "--output", default="results_check_rasters.csv", help="CSV report of the rasters"
+)
+args = parser.parse_args()
+print(args)
+
+paths = [
+    os.path.join(data_path, raster_dir, fname)
+    for raster_dir in (args.dir or ["mask_png", "mask_bin"])
+    for fname in sorted(os.listdir(os.path.join(data_path, raster_dir)))
+]
+reports = map_workers(
+    inspect_raster, [(path, args.stats) for path in paths], args.workers
+)
+reports_df = pd.DataFrame(reports)
+reports_df["path"] = [os.path.relpath(path, data_path) for path in paths]
+with pd.option_context("display.max_rows", None, "display.width", 200):
+    print(reports_df.to_string(index=False))
+reports_df.to_csv(args.output, index=False)
+print("Done!")
@@ -1,16 +1,23 @@
 import os
-import numpy as np
+import argparse
+import rasterio
 
-from skimage.io import imread, imsave
 from PIL import Image
 
+from raster_io import BitMaskWriter, iter_row_windows, stream_rows
+from task_executor import map_workers, task_scenes
+
 Image.MAX_IMAGE_PIXELS = None
 
 base_path = os.path.expanduser("~")
 data_path = os.path.join(base_path, "data", "cimat", "dataset-cimat")
 input_path = os.path.join(data_path, "mask_png")
 output_path = os.path.join(data_path, "mask_bin")
+# Masks being converted, on their own directory of the dataset (same filesystem) so
+# mask_bin only ever lists the converted masks
+tmp_path = os.path.join(data_path, "tmp_mask_bin")
 os.makedirs(output_path, exist_ok=True)
+os.makedirs(tmp_path, exist_ok=True)
 
 
 # Use SLURM array environment variables to determine training and cross validation set number
@@ -22,11 +29,39 @@ print(f"SLURM_ARRAY_JOB_ID: {slurm_array_job_id}")
 print(f"SLURM_ARRAY_TASK_ID: {slurm_array_task_id}")
 print(f"SLURM_JOB_NODELIST: {slurm_node_list}")
 
-mask_names = os.listdir(input_path)
-mask_name = mask_names[int(slurm_array_task_id) - 1]
-mask = imread(os.path.join(input_path, mask_name))
-mask = mask // 255
 
-imsave(os.path.join(output_path, mask_name), mask.astype(np.int8), check_contrast=False)
+# Convert a mask (0 and 255) to a 1 bit mask (0 and 1) decoding and writing it by
+# bands of rows, the first band of the PNG is used for masks with several channels
+def convert_mask(mask_name, strip_rows):
+    tmp_mask_path = os.path.join(tmp_path, f"{os.getpid()}_{mask_name}")
+    with rasterio.open(os.path.join(input_path, mask_name)) as dataset:
+        writer = BitMaskWriter(tmp_mask_path, dataset.width, dataset.height)
+        for window in iter_row_windows(dataset, 1, strip_rows):
+            mask = dataset.read(1, window=window)
+            writer.write_rows(mask // 255)
+        writer.close()
+    os.replace(tmp_mask_path, os.path.join(output_path, mask_name))
+    print(f"{mask_name}: {dataset.width}x{dataset.height}")
+    return mask_name
+
+
+parser = argparse.ArgumentParser(
+    prog="ConvertBinaryMasks", description="Convert the PNG masks to 1 bit masks"
+)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Masks converted at the same time"
+)
+parser.add_argument(
+    "--strip-rows", type=int, default=stream_rows, help="Rows decoded per band"
+)
+args = parser.parse_args()
+print(args)
+
+# The mask of the SLURM array task or, outside an array, all the masks
+map_workers(
+    convert_mask,
+    [(mask_name, args.strip_rows) for mask_name in task_scenes(input_path)],
+    args.workers,
+)
 
 print("Done!")
@@ -1,4 +1,5 @@
 import os
+import argparse
 import itertools
 import numpy as np
 import pandas as pd
@@ -8,6 +9,13 @@ from skimage.io import imread, imsave
 from PIL import Image
 from tqdm import tqdm
 
+from patch_counts import count_columns, save_count_fragment, scene_patch_counts
+from patch_shards import load_shard_index, shards_dir
+from raster_io import raster_shape
+from scene_stats import get_scene_stats
+from task_executor import map_workers, slurm_task, task_scenes
+from work_queue import WorkQueue, queue_path, static_patches, task_owner
+
 # Directories configuration
 home_path = os.path.expanduser("~")
 data_path = os.path.join(home_path, "data", "cimat")
@@ -38,6 +46,11 @@ def count_patch_pixels(
     dst_path,
     img_name,
     patch_size,
+    input_format="files",
+    schedule="static",
+    range_size=16,
+    ntasks=1,
+    procid=0,
 ):
     print(
         src_path,
@@ -47,21 +60,16 @@ def count_patch_pixels(
         img_name,
         patch_size,
     )
-    # In this case we are opening both image and mask to patchify at the same time
-    # considering that we are removing outside regions pixels (SAR image) and separating
-    # oil from not oil spill patches
-    image = imread(os.path.join(src_path, img_dir, img_name + ".tif"), as_gray=True)
-    mask = imread(os.path.join(src_path, mask_dir, img_name + ".png"), as_gray=True)
-    # Scale image between 0 and 1
-    min_image = np.min(image)
-    max_image = np.max(image)
-    image_scaled = (image - min_image) / (max_image - min_image)
-    # Mark all pixels on the mask above 0 as oil
-    mask[mask > 0] = 1
+    # Only the scene dimensions are needed to build the patches grid, they are read
+    # from the image and mask headers instead of loading the whole rasters
+    image_height, image_width = raster_shape(
+        os.path.join(src_path, img_dir, img_name + ".tif")
+    )
+    mask_height, mask_width = raster_shape(
+        os.path.join(src_path, mask_dir, img_name + ".png")
+    )
 
     # Verifying that image and mask have the same shape
-    image_height, image_width = image.shape
-    mask_height, mask_width = mask.shape
     if (image_height != mask_height) or (image_width != mask_width):
         print("Error, image and mask must have the same dimensions")
         exit(-1)
@@ -70,70 +78,165 @@ def count_patch_pixels(
     count_y = int(image_height // patch_size) + 1
 
     total_patches = count_x * count_y
-    patches_per_task = total_patches // int(slurm_ntasks)
-    missing_patches_per_task = total_patches % int(slurm_ntasks)
-
-    patches_indexes = [
-        int(slurm_procid) * patches_per_task + index
-        for index in range(patches_per_task)
-    ]
-    if int(slurm_procid) < missing_patches_per_task:
-        additional_index = int(slurm_ntasks) * patches_per_task + int(slurm_procid)
-        patches_indexes.append(additional_index)
-
-    print("Patches indexes: ", patches_indexes)
-
-    # Build patchex indexes to process considering the max patches, ntasks and task process id
-    patches_positions = list(itertools.product(range(count_y), range(count_x)))
-    for patch_index in patches_indexes:
-        j, i = patches_positions[patch_index]
-
-        print("Opening patch index: ", patch_index, i, j)
-        dst_img_name = img_name + f"_{patch_index:04d}_train"
-        # Get pixel positions for patch
-        patch_image = imread(
-            os.path.join(dst_path, "features", "origin", dst_img_name + ".tif")
-        )
-        patch_label = imread(os.path.join(dst_path, "labels", dst_img_name + ".png"))
-
-        # Count pixels
-        total_pixels = patch_label.shape[0] * patch_label.shape[1]
-        oil_pixels = np.count_nonzero(patch_label == 1)
-        sea_pixels = np.count_nonzero(patch_label == 0)
-
-        # Save dataframe
-        mask_patch_dict = {
-            "patch_name": [dst_img_name],
-            "total_pixels": [total_pixels],
-            "oil_pixels": [oil_pixels],
-            "sea_pixels": [sea_pixels],
-            "invalid_patch": [
+    if input_format == "shards":
+        # The shard index already holds the pixel counts and flags of every patch
+        shard_index = load_shard_index(
+            os.path.join(dst_path, shards_dir), img_name
+        ).set_index("patch_name", drop=False)
+
+    def count_patches(patches_indexes):
+        print("Patches indexes: ", list(patches_indexes))
+        if input_format == "shards":
+            patches_names = [
+                img_name + f"_{patch_index:04d}_train"
+                for patch_index in patches_indexes
+            ]
+            return shard_index.loc[patches_names, count_columns]
+
+        # Build patchex indexes to process considering the max patches, ntasks and task process id
+        patches_positions = list(itertools.product(range(count_y), range(count_x)))
+        mask_patches_dict = {column: [] for column in count_columns}
+        for patch_index in patches_indexes:
+            j, i = patches_positions[patch_index]
+
+            print("Opening patch index: ", patch_index, i, j)
+            dst_img_name = img_name + f"_{patch_index:04d}_train"
+            # Get pixel positions for patch
+            patch_image = imread(
+                os.path.join(dst_path, "features", "origin", dst_img_name + ".tif")
+            )
+            patch_label = imread(
+                os.path.join(dst_path, "labels", dst_img_name + ".png")
+            )
+
+            # Count pixels
+            total_pixels = patch_label.shape[0] * patch_label.shape[1]
+            oil_pixels = np.count_nonzero(patch_label == 1)
+            sea_pixels = np.count_nonzero(patch_label == 0)
+
+            # Accumulate patch counts
+            mask_patches_dict["patch_name"].append(dst_img_name)
+            mask_patches_dict["total_pixels"].append(total_pixels)
+            mask_patches_dict["oil_pixels"].append(oil_pixels)
+            mask_patches_dict["sea_pixels"].append(sea_pixels)
+            mask_patches_dict["invalid_patch"].append(
                 int(patch_image.min() == patch_image.max() and patch_image.max() == 1)
-            ],
-            "full_oil_patch": [
+            )
+            mask_patches_dict["full_oil_patch"].append(
                 int(patch_label.min() == patch_label.max() and patch_label.min() == 1)
-            ],
-            "full_sea_patch": [
+            )
+            mask_patches_dict["full_sea_patch"].append(
                 int(patch_label.min() == patch_label.max() and patch_label.max() == 0)
-            ],
-        }
-        mask_patch_df = pd.DataFrame.from_dict(mask_patch_dict)
-        mask_patch_df.to_csv(
-            os.path.join(dst_path, "counts", "patches", dst_img_name + ".csv")
+            )
+        return mask_patches_dict
+
+    if schedule == "queue":
+        # Ranges of patches handed out on demand to the tasks working on the scene,
+        # the counts of every range are saved as its own fragment before taking the
+        # next one
+        work_queue = WorkQueue(queue_path(dst_path, "count", img_name))
+        work_queue.add(img_name, total_patches, range_size)
+        for rowid, _, start, stop in work_queue.ranges(task_owner(procid)):
+            save_count_fragment(
+                dst_path,
+                img_name,
+                f"range_{start:06d}",
+                count_patches(range(start, stop)),
+            )
+            work_queue.complete(rowid)
+        work_queue.close()
+    else:
+        # The counts of all the patches of the task are saved as a single fragment
+        patches_indexes = static_patches(total_patches, ntasks, procid)
+        save_count_fragment(
+            dst_path,
+            img_name,
+            f"{procid:03d}",
+            count_patches(patches_indexes),
         )
 
 
-# Create output directories
-os.makedirs(dst_path, exist_ok=True)
-os.makedirs(os.path.join(dst_path, "counts", "patches"), exist_ok=True)
+# Counts of all the patches of a scene straight from the mask and image grids: the
+# oil pixels and the tile min/max of every patch are taken from the statistics
+# sidecar (or a single streamed pass over image and mask when it is missing), so the
+# patches written by the builders are not needed
+def count_scene_pixels(src_path, img_dir, mask_dir, dst_path, img_name, patch_size):
+    print(src_path, img_dir, mask_dir, dst_path, img_name, patch_size)
+    stats = get_scene_stats(src_path, img_dir, img_name, patch_size, mask_dir)
+    save_count_fragment(
+        dst_path, img_name, "scene", scene_patch_counts(stats, img_name, patch_size)
+    )
 
-fname = os.listdir(os.path.join(src_path, "image_norm"))[int(slurm_array_task_id) - 1]
-count_patch_pixels(
-    src_path,
-    "image_norm",
-    "mask_bin",
-    dst_path,
-    fname.split(".")[0],
-    patch_size,
+
+parser = argparse.ArgumentParser(
+    prog="CountPatchesPixels", description="Count oil and sea pixels of the patches"
+)
+parser.add_argument(
+    "--input-format",
+    choices=["files", "shards", "mask"],
+    default="files",
+    help="Read the patch files, the index of the packed shards or count all the "
+    "scenes from the masks",
+)
+parser.add_argument(
+    "--schedule",
+    choices=["static", "queue"],
+    default="static",
+    help="Split the patches evenly between the tasks or hand out ranges of patches "
+    "on demand from a queue shared by the tasks",
+)
+parser.add_argument(
+    "--range-size", type=int, default=16, help="Patches of every range of the queue"
+)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Local worker processes of every task"
 )
+args = parser.parse_args()
+print(args)
+
+# Create output directories
+os.makedirs(dst_path, exist_ok=True)
+os.makedirs(os.path.join(dst_path, "counts", "fragments"), exist_ok=True)
+
+if args.input_format == "mask":
+    # A single task counts every scene, on the local workers
+    map_workers(
+        count_scene_pixels,
+        [
+            (
+                src_path,
+                "image_norm",
+                "mask_bin",
+                dst_path,
+                fname.split(".")[0],
+                patch_size,
+            )
+            for fname in os.listdir(os.path.join(src_path, "image_norm"))
+        ],
+        args.workers,
+    )
+else:
+    # Every SLURM task runs as many local workers, each one as a task of its own
+    ntasks, procid = slurm_task()
+    for fname in task_scenes(os.path.join(src_path, "image_norm")):
+        map_workers(
+            count_patch_pixels,
+            [
+                (
+                    src_path,
+                    "image_norm",
+                    "mask_bin",
+                    dst_path,
+                    fname.split(".")[0],
+                    patch_size,
+                    args.input_format,
+                    args.schedule,
+                    args.range_size,
+                    ntasks * args.workers,
+                    procid * args.workers + worker,
+                )
+                for worker in range(args.workers)
+            ],
+            args.workers,
+        )
 print("Done!")
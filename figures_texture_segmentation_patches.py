@@ -1,8 +1,13 @@
 import os
 import argparse
-from glob import glob
+import numpy as np
+
 from skimage.io import imread
-from matplotlib import pyplot as plt
+from tqdm import tqdm
+
+from patch_dataset import scan_patches
+from patch_figures import contact_sheet, figure_image
+from task_executor import map_workers
 
 # Path configuration
 home_path = os.path.expanduser("~")
@@ -13,72 +18,107 @@ figures_path = os.path.join(
     data_path, "dataset-cimat", "segmentation", "figures", "texture"
 )
 
+
+# Save every page, a figure with the image, label and texture patches of each of its
+# patches on a contact sheet of the given columns (a single patch page is its figure)
+def render_pages(figures_path, pages, columns):
+    for page_name, patches in tqdm(pages):
+        figures = []
+        for patch_name, panels in patches:
+            figures.append(
+                figure_image(
+                    patch_name,
+                    [imread(path) for _, path in panels],
+                    [title for title, _ in panels],
+                    # Two rows of panels filled row by row, image and mask first
+                    -(-len(panels) // 2),
+                )
+            )
+        sheet = contact_sheet(figures, min(columns, len(figures)))
+        sheet.save(os.path.join(figures_path, page_name + ".png"))
+    return len(pages)
+
+
 parser = argparse.ArgumentParser(
     prog="FiguresTexturePatches", description="Generate figures for texture patches"
 )
 parser.add_argument("--filename")
+parser.add_argument("--workers", type=int, default=1, help="Local worker processes")
+parser.add_argument(
+    "--sheet-size",
+    type=int,
+    default=0,
+    help="Patches per contact sheet page, a figure per patch when 0",
+)
+parser.add_argument(
+    "--sheet-columns", type=int, default=4, help="Patches per row of the pages"
+)
 args = parser.parse_args()
 # print(args)
 
+os.makedirs(figures_path, exist_ok=True)
+
 # Traverse features and label path to get patches and generate figures
 fname = args.filename.split(".")[0]
 
-# Get image and label patches
-image_patches = glob(os.path.join(feat_path, "origin", f"{fname}_*.tif"))
-label_patches = glob(os.path.join(label_path, f"{fname}_*.png"))
+# Index of the image, label and texture patches of the scene, every directory is
+# scanned once
+image_patches = scan_patches(os.path.join(feat_path, "origin"), f"{fname}_", ".tif")
+label_patches = scan_patches(label_path, f"{fname}_", ".png")
 print(f"Image name: {fname}")
 print(f"Image patches: {len(image_patches)}, label patches: {len(label_patches)}")
 if len(image_patches) != len(label_patches):
     print("Error on patches num")
 # Get texture patches
-for texture_path in os.listdir(os.path.join(feat_path, "texture")):
-    texture_patches = glob(
-        os.path.join(feat_path, "texture", texture_path, f"{fname}_*.tif")
+texture_dirs = sorted(os.listdir(os.path.join(feat_path, "texture")))
+texture_patches = {}
+for texture_dir in texture_dirs:
+    texture_patches[texture_dir] = scan_patches(
+        os.path.join(feat_path, "texture", texture_dir), f"{fname}_", ".tif"
     )
-    print(f"Texture {texture_path} patches: {len(texture_patches)}")
-    if len(image_patches) != len(texture_patches):
-        print(f"Error on texture {texture_path} patches num")
+    print(f"Texture {texture_dir} patches: {len(texture_patches[texture_dir])}")
+    if len(image_patches) != len(texture_patches[texture_dir]):
+        print(f"Error on texture {texture_dir} patches num")
 
-# Num of patches are ok now we proceed to traverse all image patches to verify that the
-# corresponding label and texture patches exists
-for image_patch in image_patches:
-    # Extract patch filename
-    patch_name = image_patch.split("/")[-1]
-    print(patch_name)
-    # Check if label and texture features exists
-    if not os.path.exists(os.path.join(label_path, patch_name.split(".")[0] + ".png")):
-        print(f"Label doesn't exists for patch name: {patch_name}")
-    for texture_path in os.listdir(os.path.join(feat_path, "texture")):
-        if not os.path.exists(
-            os.path.join(feat_path, "texture", texture_path, patch_name)
-        ):
-            print(
-                f"Texture {texture_path} image doesn't exists for patch name: {patch_name}"
-            )
-
-    # Now generate figure with image, label and texture patches
-
-    # Save figure with image and mask patches
-    fig, ax = plt.subplots(2, 6, figsize=(12, 8))
-    image = imread(image_patch, as_gray=True)
-    ax[0, 0].imshow(image, cmap="gray")
-    ax[0, 0].set_title("Image patch")
-    label = imread(
-        os.path.join(label_path, patch_name.split(".")[0] + ".png"), as_gray=True
-    )
-    ax[1, 0].imshow(label, cmap="gray")
-    ax[1, 0].set_title("Mask patch")
-    for index, texture_path in enumerate(
-        os.listdir(os.path.join(feat_path, "texture"))
+# Num of patches are ok now we verify that the corresponding label and texture patches
+# of every image patch exist, as differences of the sets of names
+patch_names = sorted(image_patches)
+for patch_name in sorted(image_patches.keys() - label_patches.keys()):
+    print(f"Label doesn't exists for patch name: {patch_name}.tif")
+for texture_dir in texture_dirs:
+    for patch_name in sorted(
+        image_patches.keys() - texture_patches[texture_dir].keys()
     ):
-        texture = imread(
-            os.path.join(feat_path, "texture", texture_path, patch_name), as_gray=True
+        print(
+            f"Texture {texture_dir} image doesn't exists for patch name: {patch_name}.tif"
         )
-        ax[index % 2, index % 5 + 1].imshow(texture, cmap="gray")
-        ax[index % 2, index % 5 + 1].set_title(f"Texture {texture_path}")
-    fig.tight_layout()
-    fig.suptitle(patch_name)
-    plt.savefig(os.path.join(figures_path, patch_name.split(".")[0] + ".png"))
-    plt.close()
+
+# Panels of every patch with the existing patches only
+patches = []
+for patch_name in patch_names:
+    panels = [("Image patch", image_patches[patch_name])]
+    if patch_name in label_patches:
+        panels.append(("Mask patch", label_patches[patch_name]))
+    for texture_dir in texture_dirs:
+        if patch_name in texture_patches[texture_dir]:
+            panels.append(
+                (f"Texture {texture_dir}", texture_patches[texture_dir][patch_name])
+            )
+    patches.append((patch_name, panels))
+
+# A page per patch or contact sheets of sheet_size patches, rendered by the workers
+if args.sheet_size > 0:
+    pages = [
+        (f"{fname}_sheet_{page:04d}", patches[start : start + args.sheet_size])
+        for page, start in enumerate(range(0, len(patches), args.sheet_size))
+    ]
+else:
+    pages = [(patch_name, [(patch_name, panels)]) for patch_name, panels in patches]
+chunks = np.array_split(np.arange(len(pages)), max(args.workers, 1))
+map_workers(
+    render_pages,
+    [(figures_path, [pages[i] for i in chunk], args.sheet_columns) for chunk in chunks],
+    args.workers,
+)
 
 print("Done!")
@@ -1,8 +1,12 @@
 import os
+import argparse
+import numpy as np
 import rasterio
 from rasterio.transform import rowcol
+from rasterio.windows import Window
 import pandas as pd
 import geopandas as gpd
+from shapely.geometry import box
 import matplotlib.pyplot as plt
 import re
 from tqdm import tqdm
@@ -14,6 +18,30 @@ ruta_imagenes = os.path.join(data_path, "sentinel1", "TIFF")
 ruta_csv = os.path.join(data_path, "noaa_sentinel1_products.csv")
 output_dir = os.path.join(data_path, "sentinel1", "TIFF_OP")
 os.makedirs(output_dir, exist_ok=True)  # Crear la carpeta si no existe
+# Parte fija del identificador (inicio, fin y órbita) usada como llave del índice
+patron_llave = re.compile(r"\d{8}T\d{6}_\d{8}T\d{6}_\d{6}")
+
+parser = argparse.ArgumentParser(
+    prog="GeoLocal", description="Resaltar los puntos de los productos en las imágenes"
+)
+parser.add_argument(
+    "--footprints",
+    action="store_true",
+    help="Asignar los puntos sin producto coincidente a la imagen cuya huella "
+    "(bounding box) los contiene, con un índice espacial",
+)
+parser.add_argument(
+    "--max-size",
+    type=int,
+    help="Píxeles por lado de la vista completa, diezmada (completa si no se da)",
+)
+parser.add_argument(
+    "--crop",
+    type=int,
+    help="Guardar además un recorte de crop x crop píxeles alrededor de cada punto",
+)
+args = parser.parse_args()
+print(args)
 
 # Leer las coordenadas del archivo CSV con GeoPandas
 df = pd.read_csv(ruta_csv)
@@ -36,58 +64,141 @@ def extraer_identificador(nombre_producto):
     return match.group(0) if match else None
 
 
-# Crear diccionario de coincidencias
+# Guardar los datos (bandas, filas, columnas) con los píxeles de los puntos resaltados
+def guardar_resaltado(datos, filas, columnas, output_ruta, figsize, dpi):
+    if datos.shape[0] >= 3:
+        datos[0, filas, columnas] = 255
+        datos[1, filas, columnas] = 0
+        datos[2, filas, columnas] = 0
+    else:
+        datos[0, filas, columnas] = datos[0].max()
+
+    plt.figure(figsize=figsize)
+    if datos.shape[0] == 1:
+        plt.imshow(datos[0], cmap="gray")
+    else:
+        plt.imshow(datos[:3].transpose(1, 2, 0))
+    plt.scatter(columnas, filas, color="red", s=50)
+    plt.axis("off")
+    plt.savefig(output_ruta, dpi=dpi, bbox_inches="tight")
+    plt.close()
+
+
+# Índice de las imágenes por la parte fija de su identificador, cada nombre se analiza
+# una sola vez
+print("Creando índice de imágenes")
+indice_imagenes = {}
+for imagen in imagenes:
+    for llave in patron_llave.findall(imagen):
+        indice_imagenes.setdefault(llave, []).append(imagen)
+
+# Crear diccionario de coincidencias, una búsqueda en el índice por producto (solo las
+# pocas imágenes con la misma llave se comparan con el identificador completo)
 print("Creando diccionario de coincidencias")
 coincidencias = {}
-for idx, row in gdf.iterrows():
-    productos = row["products"].strip("[]").split(", ")
+for productos_fila in gdf["products"].unique():
+    productos = productos_fila.strip("[]").split(", ")
     print(productos)
     for producto in productos:
         identificador = extraer_identificador(producto)
         if identificador:
-            for imagen in imagenes:
+            llave = patron_llave.match(identificador).group(0)
+            for imagen in indice_imagenes.get(llave, []):
                 if identificador in imagen:
-                    coincidencias[row["products"]] = imagen
+                    coincidencias[productos_fila] = imagen
                     break
+gdf["imagen"] = gdf["products"].map(coincidencias)
 
-# Procesar todas las imágenes
-print("Procesando imágenes")
-for idx, row in tqdm(gdf.iterrows()):
-    producto = row["products"]
-    if producto not in coincidencias:
-        continue  # Saltar si no hay coincidencia
+# Asignar los puntos sin coincidencia a la imagen que los contiene: las huellas de las
+# imágenes se leen de sus encabezados y se unen con los puntos con el índice espacial
+# de GeoPandas (R-tree cuando rtree está instalado)
+if args.footprints:
+    print("Asignando puntos por huella")
+    huellas = []
+    for imagen in imagenes:
+        with rasterio.open(os.path.join(ruta_imagenes, imagen)) as dataset:
+            huellas.append(box(*dataset.bounds))
+    huellas = gpd.GeoDataFrame({"imagen_huella": imagenes}, geometry=huellas)
+    sin_imagen = gdf[gdf["imagen"].isna()]
+    unidos = gpd.sjoin(
+        sin_imagen[["geometry"]], huellas, how="inner", predicate="within"
+    )
+    # La primera imagen que contiene cada punto
+    unidos = unidos[~unidos.index.duplicated(keep="first")]
+    gdf.loc[unidos.index, "imagen"] = unidos["imagen_huella"]
+    print(f"Puntos asignados por huella: {len(unidos)}")
 
-    ruta_imagen = os.path.join(ruta_imagenes, coincidencias[producto])
-    lat, lon = row["lat"], row["lon"]
+# Procesar todas las imágenes, cada imagen se abre una sola vez con todos sus puntos
+print("Procesando imágenes")
+puntos_por_imagen = gdf.dropna(subset=["imagen"]).groupby("imagen")
+for imagen, puntos in tqdm(puntos_por_imagen, total=puntos_por_imagen.ngroups):
+    ruta_imagen = os.path.join(ruta_imagenes, imagen)
 
     with rasterio.open(ruta_imagen) as dataset:
-        fila, columna = rowcol(dataset.transform, lon, lat)
-        datos = dataset.read()
-
-        # Validar si el píxel está dentro de los límites
-        if 0 <= fila < datos.shape[1] and 0 <= columna < datos.shape[2]:
-            # Crear copia y resaltar el píxel
-            datos_copia = datos.copy()
-            if datos_copia.shape[0] >= 3:
-                datos_copia[0, fila, columna] = 255
-                datos_copia[1, fila, columna] = 0
-                datos_copia[2, fila, columna] = 0
-            else:
-                datos_copia[0, fila, columna] = datos_copia[0].max()
-
-            # Guardar la imagen resaltada en formato PNG
-            output_ruta = os.path.join(
-                output_dir,
-                os.path.basename(ruta_imagen).replace(".tif", "_resaltado.png"),
+        filas, columnas = rowcol(
+            dataset.transform, puntos["lon"].to_numpy(), puntos["lat"].to_numpy()
+        )
+        filas, columnas = np.asarray(filas), np.asarray(columnas)
+
+        # Validar si los píxeles están dentro de los límites
+        dentro = (
+            (0 <= filas)
+            & (filas < dataset.height)
+            & (0 <= columnas)
+            & (columnas < dataset.width)
+        )
+        if not dentro.any():
+            continue
+        filas, columnas = filas[dentro], columnas[dentro]
+
+        # Vista completa de la imagen, diezmada a max_size píxeles por lado (GDAL
+        # usa las overviews de la imagen si las tiene) o completa
+        escala = 1
+        if args.max_size:
+            escala = max(1, -(-max(dataset.height, dataset.width) // args.max_size))
+        datos = dataset.read(
+            out_shape=(
+                dataset.count,
+                -(-dataset.height // escala),
+                -(-dataset.width // escala),
             )
-            plt.figure(figsize=(10, 10))
-            if datos.shape[0] == 1:
-                plt.imshow(datos_copia[0], cmap="gray")
-            else:
-                plt.imshow(datos_copia[:3].transpose(1, 2, 0))
-            plt.scatter([columna], [fila], color="red", s=50)
-            plt.axis("off")
-            plt.savefig(output_ruta, dpi=300, bbox_inches="tight")
-            plt.close()
+        )
+        # Guardar la imagen resaltada en formato PNG
+        output_ruta = os.path.join(
+            output_dir,
+            os.path.basename(ruta_imagen).replace(".tif", "_resaltado.png"),
+        )
+        guardar_resaltado(
+            datos, filas // escala, columnas // escala, output_ruta, (10, 10), 300
+        )
+
+        # Recorte de crop x crop píxeles alrededor de cada punto, leído por ventana
+        # (recortada en los bordes de la imagen)
+        if args.crop:
+            for punto, fila, columna in zip(puntos.index[dentro], filas, columnas):
+                fila_inicio = max(0, fila - args.crop // 2)
+                columna_inicio = max(0, columna - args.crop // 2)
+                recorte = dataset.read(
+                    window=Window(
+                        columna_inicio,
+                        fila_inicio,
+                        min(args.crop, dataset.width - columna_inicio),
+                        min(args.crop, dataset.height - fila_inicio),
+                    )
+                )
+                output_ruta = os.path.join(
+                    output_dir,
+                    os.path.basename(ruta_imagen).replace(
+                        ".tif", f"_{punto}_recorte.png"
+                    ),
+                )
+                guardar_resaltado(
+                    recorte,
+                    [fila - fila_inicio],
+                    [columna - columna_inicio],
+                    output_ruta,
+                    (5, 5),
+                    100,
+                )
 
 print("Procesamiento completado. Todas las imágenes resaltadas han sido guardadas.")
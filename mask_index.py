@@ -0,0 +1,162 @@
+import os
+import numpy as np
+import rasterio
+
+from patch_grid import grid_size, patch_offset
+from raster_io import TileReader, iter_row_windows
+from scene_stats import stats_path
+
+
+# Index of a mask on the statistics directory (stats/<mask dir>/<scene>.npz)
+def mask_index_path(src_path, mask_dir, img_name):
+    return stats_path(src_path, mask_dir, img_name)
+
+
+# Oil pixels of every row of a band of rows inside each grid column, including the
+# clamped last column, the result has shape (rows, count_x)
+def column_oil_pixels(rows, patch_size):
+    height, width = rows.shape
+    count_x = int(width // patch_size) + 1
+    x_last = patch_offset(count_x - 1, width, patch_size)
+    oil = rows > 0
+    blocks = oil[:, : (count_x - 1) * patch_size].reshape(
+        height, count_x - 1, patch_size
+    )
+    return np.concatenate(
+        [
+            np.count_nonzero(blocks, axis=2),
+            np.count_nonzero(oil[:, x_last : x_last + patch_size], axis=1)[:, None],
+        ],
+        axis=1,
+    )
+
+
+# Run-length index of a mask built streaming it once in row bands: the runs of oil
+# pixels (above 0) of every row, as start and length with the first run of each row
+# on row_offsets, and the oil pixels of every patch of the grid
+def build_mask_index(mask_path, patch_size):
+    run_starts = []
+    run_lengths = []
+    run_counts = []
+    column_pixels = []
+    with rasterio.open(mask_path) as dataset:
+        width, height = dataset.width, dataset.height
+        for window in iter_row_windows(dataset):
+            rows = dataset.read(1, window=window)
+            oil = np.zeros((rows.shape[0], width + 2), dtype=np.int8)
+            oil[:, 1:-1] = rows > 0
+            # Runs start where a row goes from 0 to 1 and end where it goes back to
+            # 0, both found in row-major order
+            row, column = np.nonzero(np.diff(oil, axis=1))
+            starts, ends = column[0::2], column[1::2]
+            run_starts.append(starts.astype(np.int32))
+            run_lengths.append((ends - starts).astype(np.int32))
+            run_counts.append(np.bincount(row[0::2], minlength=rows.shape[0]))
+            column_pixels.append(column_oil_pixels(rows, patch_size))
+    column_pixels = np.concatenate(column_pixels)
+    # Oil pixels of every patch from the cumulative per row counts of its column
+    cumulative_pixels = np.zeros((height + 1, column_pixels.shape[1]), dtype=np.int64)
+    np.cumsum(column_pixels, axis=0, out=cumulative_pixels[1:])
+    _, count_y = grid_size(width, height, patch_size)
+    y = np.array([patch_offset(j, height, patch_size) for j in range(count_y)])
+    return {
+        "width": width,
+        "height": height,
+        "patch_size": patch_size,
+        "row_offsets": np.concatenate([[0], np.cumsum(np.concatenate(run_counts))]),
+        "run_starts": np.concatenate(run_starts),
+        "run_lengths": np.concatenate(run_lengths),
+        "oil_pixels": cumulative_pixels[y + patch_size] - cumulative_pixels[y],
+    }
+
+
+# Whether the index of a mask is up to date: built with the same patch size after the
+# last modification of the mask
+def has_mask_index(src_path, mask_dir, img_name, patch_size):
+    path = mask_index_path(src_path, mask_dir, img_name)
+    mask_path = os.path.join(src_path, mask_dir, img_name + ".png")
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(mask_path):
+        return False
+    with np.load(path) as data:
+        return data["patch_size"][()] == patch_size
+
+
+# Index of a mask, None when it isn't up to date
+def load_mask_index(src_path, mask_dir, img_name, patch_size):
+    if not has_mask_index(src_path, mask_dir, img_name, patch_size):
+        return None
+    with np.load(mask_index_path(src_path, mask_dir, img_name)) as data:
+        index = {key: data[key][()] for key in data.files}
+    return MaskIndex(os.path.join(src_path, mask_dir, img_name + ".png"), index)
+
+
+class MaskIndex:
+    # Mask served from its run-length index: the oil pixels of the grid patches are
+    # known without reading the mask and the rows of a tile are painted from their
+    # runs (nothing to paint on empty tiles), so the PNG is never decoded. Reads
+    # like a TileReader of the mask with values 0 and 1
+    def __init__(self, path, index):
+        self.path = path
+        self.width = int(index["width"])
+        self.height = int(index["height"])
+        self.patch_size = int(index["patch_size"])
+        self.row_offsets = index["row_offsets"]
+        self.run_starts = index["run_starts"]
+        self.run_lengths = index["run_lengths"]
+        self.oil_pixels = index["oil_pixels"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    # Empty, full and partial patches of the grid (row-major order)
+    def patch_states(self):
+        oil_pixels = self.oil_pixels.ravel()
+        empty = oil_pixels == 0
+        full = oil_pixels == self.patch_size * self.patch_size
+        return empty, full, ~empty & ~full
+
+    # Mask of the window (x, y, width, height) painted from the runs of its rows
+    def read_window(self, x, y, width, height):
+        first, last = self.row_offsets[y], self.row_offsets[y + height]
+        window = np.zeros((height, width + 1), dtype=np.int32)
+        if first == last:
+            return window[:, :width].astype(np.uint8)
+        rows = np.repeat(
+            np.arange(height), np.diff(self.row_offsets[y : y + height + 1])
+        )
+        starts = np.clip(self.run_starts[first:last] - x, 0, width)
+        ends = np.clip(
+            self.run_starts[first:last] + self.run_lengths[first:last] - x, 0, width
+        )
+        # +1 where a run starts and -1 where it ends, accumulated along the rows
+        np.add.at(window, (rows, starts), 1)
+        np.add.at(window, (rows, ends), -1)
+        return np.cumsum(window[:, :width], axis=1).astype(np.uint8)
+
+    def read_tile(self, x, y, patch_size):
+        return self.read_window(x, y, patch_size, patch_size)
+
+    def read_rows(self, y, height):
+        return self.read_window(0, y, self.width, height)
+
+    def prefetch_row(self, y, row, patch_size):
+        pass
+
+    def min_max(self):
+        has_oil = len(self.run_starts) > 0
+        full = has_oil and int(self.run_lengths.sum()) == self.width * self.height
+        return np.uint8(full), np.uint8(has_oil)
+
+
+# Reader of a mask, its run-length index when it is up to date or the PNG otherwise
+def open_mask(src_path, mask_dir, img_name, patch_size):
+    reader = load_mask_index(src_path, mask_dir, img_name, patch_size)
+    if reader is None:
+        reader = TileReader(os.path.join(src_path, mask_dir, img_name + ".png"))
+    return reader
@@ -0,0 +1,100 @@
+import os
+import glob
+import importlib.util
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+
+counts_dir = "counts"
+fragments_dir = "fragments"
+count_columns = [
+    "patch_name",
+    "total_pixels",
+    "oil_pixels",
+    "sea_pixels",
+    "invalid_patch",
+    "full_oil_patch",
+    "full_sea_patch",
+]
+# Fragments are saved as Parquet when pyarrow is installed, as CSV otherwise
+fragment_extension = ".parquet" if importlib.util.find_spec("pyarrow") else ".csv"
+
+
+def fragment_dir(dst_path, img_name):
+    return os.path.join(dst_path, counts_dir, fragments_dir, img_name)
+
+
+# Save the counts of the patches processed by a task as a single table
+# (counts/fragments/<scene>/<task>.parquet or .csv), replacing the previous one
+def save_count_fragment(dst_path, img_name, task, counts):
+    path = os.path.join(fragment_dir(dst_path, img_name), task + fragment_extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    counts = pd.DataFrame(counts, columns=count_columns)
+    if fragment_extension == ".parquet":
+        counts.to_parquet(tmp_path, index=False)
+    else:
+        counts.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_count_fragment(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+# Counts of the patches of a scene, or of all the scenes when img_name is None,
+# concatenated from the fragments of their tasks (read concurrently) with the scene
+# of every patch on the scene column. Fragments are concatenated from the oldest to
+# the newest, so the last count of a patch is the one of the latest run even when
+# fragments of runs with another schedule or tasks were left on the scene
+def load_count_fragments(dst_path, img_name=None):
+    scene_dir = fragment_dir(dst_path, "*" if img_name is None else img_name)
+    paths = sorted(
+        glob.glob(os.path.join(scene_dir, "*.parquet"))
+        + glob.glob(os.path.join(scene_dir, "*.csv"))
+    )
+    paths.sort(key=os.path.getmtime)
+    if not paths:
+        return pd.DataFrame(columns=["scene"] + count_columns)
+    with ThreadPoolExecutor() as executor:
+        fragments = list(executor.map(read_count_fragment, paths))
+    return pd.concat(
+        [
+            fragment.assign(scene=os.path.basename(os.path.dirname(path)))
+            for path, fragment in zip(paths, fragments)
+        ],
+        ignore_index=True,
+    )
+
+
+# Counts and flags of every patch of the grid (row-major order) from the per patch
+# reductions of the scene statistics sidecar, without reading any patch. Same flags
+# than counting the written patches: the scaled image patch is invalid when all its
+# values are 1 (the raw values all equal to the scene max), the label patch is full
+# oil or full sea when all its pixels are oil or sea
+def scene_patch_counts(stats, img_name, patch_size):
+    tile_min = stats["tile_min"].ravel()
+    tile_max = stats["tile_max"].ravel()
+    oil_pixels = stats["oil_pixels"].ravel().astype(np.int64)
+    total_pixels = np.full(len(oil_pixels), patch_size * patch_size, dtype=np.int64)
+    return pd.DataFrame(
+        {
+            "patch_name": [
+                img_name + f"_{patch_index:04d}_train"
+                for patch_index in range(len(oil_pixels))
+            ],
+            "total_pixels": total_pixels,
+            "oil_pixels": oil_pixels,
+            "sea_pixels": total_pixels - oil_pixels,
+            "invalid_patch": (
+                (tile_min == stats["max"]) & (tile_max == stats["max"])
+            ).astype(np.int64),
+            "full_oil_patch": (oil_pixels == total_pixels).astype(np.int64),
+            "full_sea_patch": (oil_pixels == 0).astype(np.int64),
+        },
+        columns=count_columns,
+    )
@@ -0,0 +1,141 @@
+import os
+import glob
+import fnmatch
+import numpy as np
+import pandas as pd
+
+from numpy.lib.format import open_memmap
+from skimage.io import imread
+from tqdm import tqdm
+
+from patch_shards import (
+    load_shard_index,
+    read_shard_patches,
+    shard_patch_format,
+    shards_dir,
+)
+
+images_file = "images.npy"
+labels_file = "labels.npy"
+names_file = "patches.csv"
+
+
+# Names of the patches with both the origin feature and the label saved as files
+def patch_names(dst_path, pattern="*"):
+    images = glob.glob(os.path.join(dst_path, "features", "origin", pattern + ".tif"))
+    names = [os.path.basename(image).split(".")[0] for image in images]
+    return sorted(
+        name
+        for name in names
+        if os.path.exists(os.path.join(dst_path, "labels", name + ".png"))
+    )
+
+
+# Patch files of a directory whose name starts with prefix, {name: path}, listed
+# with a single scandir (no stat nor glob per file)
+def scan_patches(directory, prefix="", extension=None):
+    patches = {}
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return patches
+    with entries:
+        for entry in entries:
+            name, entry_extension = os.path.splitext(entry.name)
+            if not name.startswith(prefix):
+                continue
+            if extension is not None and entry_extension != extension:
+                continue
+            patches[name] = entry.path
+    return patches
+
+
+# Pack the patches written by the builders (files or shards) into two fixed stride
+# arrays saved as .npy (images as image_dtype, labels as uint8) plus the list of the
+# patch names, so they can be memory mapped by PatchDataset
+def pack_patch_dataset(
+    dst_path, out_path, pattern="*", source="files", image_dtype=np.float16
+):
+    os.makedirs(out_path, exist_ok=True)
+    if source == "shards":
+        index = load_shard_index(os.path.join(dst_path, shards_dir))
+        index = index[
+            [fnmatch.fnmatchcase(name, pattern) for name in index["patch_name"]]
+        ]
+        index = index.sort_values("patch_name").reset_index(drop=True)
+        names = index["patch_name"].tolist()
+    else:
+        names = patch_names(dst_path, pattern)
+    if not names:
+        raise ValueError(f"No patches found on {dst_path} for {pattern}")
+
+    if source == "shards":
+        patch_shape, _ = shard_patch_format(
+            os.path.join(dst_path, shards_dir),
+            os.path.join("features", "origin"),
+            index["shard"].iloc[0],
+        )
+    else:
+        patch_shape = imread(
+            os.path.join(dst_path, "features", "origin", names[0] + ".tif")
+        ).shape
+    images_map = open_memmap(
+        os.path.join(out_path, images_file),
+        mode="w+",
+        dtype=image_dtype,
+        shape=(len(names),) + patch_shape,
+    )
+    labels_map = open_memmap(
+        os.path.join(out_path, labels_file),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(names),) + patch_shape,
+    )
+    if source == "shards":
+        # Copied shard by shard from the mapped shards to the mapped dataset
+        read_shard_patches(
+            os.path.join(dst_path, shards_dir),
+            os.path.join("features", "origin"),
+            index,
+            images_map,
+        )
+        read_shard_patches(
+            os.path.join(dst_path, shards_dir), "labels", index, labels_map
+        )
+    else:
+        for i, name in enumerate(tqdm(names)):
+            images_map[i] = imread(
+                os.path.join(dst_path, "features", "origin", name + ".tif")
+            )
+            labels_map[i] = imread(os.path.join(dst_path, "labels", name + ".png"))
+    images_map.flush()
+    labels_map.flush()
+    pd.DataFrame({"patch_name": names}).to_csv(
+        os.path.join(out_path, names_file), index=False
+    )
+    return len(names)
+
+
+class PatchDataset:
+    # Patches packed by pack_patch_dataset, memory mapped (read only). An integer
+    # index returns the (image, label) pair of a patch and a slice returns the batch
+    # of images and labels, both as views on the mapped files without any decoding
+    def __init__(self, path):
+        self.path = path
+        self.images = np.load(os.path.join(path, images_file), mmap_mode="r")
+        self.labels = np.load(os.path.join(path, labels_file), mmap_mode="r")
+        self.names = pd.read_csv(os.path.join(path, names_file))["patch_name"].tolist()
+        if not (len(self.images) == len(self.labels) == len(self.names)):
+            raise ValueError(f"Images, labels and names differ in length on {path}")
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        return self.images[index], self.labels[index]
+
+    def batch(self, start, size):
+        return self[start : start + size]
+
+    def index_of(self, patch_name):
+        return self.names.index(patch_name)
@@ -0,0 +1,101 @@
+import re
+import numpy as np
+
+from PIL import Image, ImageDraw
+
+# Pixels around the panels and for the titles
+figure_margin = 8
+title_height = 16
+# Patch name of the segmentation ({scene}_{index}_train) and texture ({scene}_{index})
+# builders, the augmented copies end with _augNNN
+patch_name_pattern = re.compile(
+    r"^(?P<scene>.+)_(?P<index>\d{4})(?P<train>_train)?(?P<aug>_aug\d{3})?$"
+)
+
+
+# Gray panel of a patch scaled to its own min and max (as imshow with a gray cmap)
+def gray_panel(patch):
+    patch = np.asarray(patch, dtype=np.float32)
+    if patch.ndim == 3:
+        patch = patch.mean(axis=2)
+    min_value, max_value = patch.min(), patch.max()
+    if max_value > min_value:
+        patch = (patch - min_value) / (max_value - min_value) * 255
+    else:
+        patch = np.zeros_like(patch)
+    return Image.fromarray(patch.astype(np.uint8), mode="L")
+
+
+# Figure of a patch composited with PIL: the panels on a grid of the given columns,
+# each one with its title, and the patch name on top
+def figure_image(title, panels, panel_titles, columns=None):
+    columns = columns or len(panels)
+    rows = -(-len(panels) // columns)
+    panels = [gray_panel(panel) for panel in panels]
+    panel_height = max(panel.height for panel in panels)
+    panel_width = max(panel.width for panel in panels)
+    cell_height = title_height + panel_height + figure_margin
+    cell_width = panel_width + figure_margin
+    figure = Image.new(
+        "L",
+        (
+            columns * cell_width + figure_margin,
+            title_height + rows * cell_height + figure_margin,
+        ),
+        255,
+    )
+    draw = ImageDraw.Draw(figure)
+    draw.text((figure_margin, 2), title, fill=0)
+    for i, (panel, panel_title) in enumerate(zip(panels, panel_titles)):
+        x = figure_margin + (i % columns) * cell_width
+        y = title_height + (i // columns) * cell_height + figure_margin
+        draw.text((x, y), panel_title, fill=0)
+        figure.paste(panel, (x, y + title_height))
+        # Frame of the panel, as the axes of a matplotlib figure
+        draw.rectangle(
+            (
+                x - 1,
+                y + title_height - 1,
+                x + panel.width,
+                y + title_height + panel.height,
+            ),
+            outline=0,
+        )
+    return figure
+
+
+# Contact sheet page with the figures given on a grid of the given columns
+def contact_sheet(figures, columns):
+    rows = -(-len(figures) // columns)
+    cell_width = max(figure.width for figure in figures)
+    cell_height = max(figure.height for figure in figures)
+    sheet = Image.new("L", (columns * cell_width, rows * cell_height), 255)
+    for i, figure in enumerate(figures):
+        sheet.paste(figure, ((i % columns) * cell_width, (i // columns) * cell_height))
+    return sheet
+
+
+# Scene of a patch name, None when it doesn't follow the builders names
+def patch_scene(patch_name):
+    match = patch_name_pattern.match(patch_name)
+    return match.group("scene") if match else None
+
+
+# Patches to render: every nth patch of each scene and/or k random patches per
+# scene (seeded), in the order given
+def sample_patches(patches_names, every=None, per_scene=None, seed=0):
+    scenes = {}
+    for patch_name in patches_names:
+        scenes.setdefault(patch_scene(patch_name), []).append(patch_name)
+    rng = np.random.default_rng(seed)
+    selected = set()
+    for scene_names in scenes.values():
+        if every is not None:
+            scene_names = scene_names[::every]
+        if per_scene is not None and per_scene < len(scene_names):
+            scene_names = [
+                scene_names[i]
+                for i in sorted(rng.choice(len(scene_names), per_scene, replace=False))
+            ]
+        selected.update(scene_names)
+    return [patch_name for patch_name in patches_names if patch_name in selected]
@@ -0,0 +1,91 @@
+import itertools
+import numpy as np
+
+
+# Number of patches along each axis, the last column and row are clamped to the
+# image border so the whole scene is covered
+def grid_size(image_width, image_height, patch_size):
+    count_x = int(image_width // patch_size) + 1
+    count_y = int(image_height // patch_size) + 1
+    return count_x, count_y
+
+
+# Pixel offset of the patch i along an axis of the given size
+def patch_offset(i, size, patch_size):
+    offset = patch_size * i
+    # Crop whenever patch size is outside image
+    if offset + patch_size > size:
+        offset = size - patch_size - 1
+    return offset
+
+
+# Pixel position of the patch (j, i) of the grid
+def patch_position(j, i, image_width, image_height, patch_size):
+    x = patch_offset(i, image_width, patch_size)
+    y = patch_offset(j, image_height, patch_size)
+    return x, y
+
+
+# Group patch indexes (row-major order over the grid) by grid row, yielding the
+# row pixel position and the (index, x) pairs of the patches in that row so the
+# readers can fetch a single band of rows per grid row
+def patch_rows(patches_indexes, image_width, image_height, patch_size):
+    count_x, _ = grid_size(image_width, image_height, patch_size)
+    for j, indexes in itertools.groupby(
+        sorted(patches_indexes), key=lambda index: index // count_x
+    ):
+        row = []
+        for index in indexes:
+            x, y = patch_position(
+                j, index % count_x, image_width, image_height, patch_size
+            )
+            row.append((index, x))
+        yield y, row
+
+
+# Reduce every patch of a band holding k rows of the grid (k * patch_size rows over
+# the whole image width), including the clamped last column. The band is seen as a
+# (k, patch_size, count_x - 1, patch_size) block view so func (np.min, np.max,
+# np.sum, ...) runs once over all the patches, the result has shape (k, count_x)
+def band_reduce(band, patch_size, func):
+    rows, width = band.shape
+    count_x = int(width // patch_size) + 1
+    k = rows // patch_size
+    x_last = patch_offset(count_x - 1, width, patch_size)
+    blocks = band[:, : (count_x - 1) * patch_size].reshape(
+        k, patch_size, count_x - 1, patch_size
+    )
+    last = band[:, x_last : x_last + patch_size].reshape(k, patch_size, patch_size)
+    return np.concatenate(
+        [func(blocks, axis=(1, 3)), func(last, axis=(1, 2))[:, None]], axis=1
+    )
+
+
+# Reduce every patch of the grid of a whole image, the result has shape
+# (count_y, count_x). The regular rows are reduced as a single block view and the
+# clamped last row (y = image_height - patch_size - 1) as a second band
+def grid_reduce(image, patch_size, func):
+    image_height, image_width = image.shape
+    _, count_y = grid_size(image_width, image_height, patch_size)
+    y_last = patch_offset(count_y - 1, image_height, patch_size)
+    return np.concatenate(
+        [
+            band_reduce(image[: (count_y - 1) * patch_size], patch_size, func),
+            band_reduce(image[y_last : y_last + patch_size], patch_size, func),
+        ]
+    )
+
+
+# Count of oil pixels (above 0) over the given axes of a mask block view
+def oil_pixels_reduce(mask, axis):
+    return np.count_nonzero(mask > 0, axis=axis)
+
+
+# Patch categories from the per patch reductions: invalid patches (image values all
+# equal to invalid_value, 0 outside the SAR image), empty patches (valid without oil
+# pixels) and full oil patches (valid with only oil pixels)
+def classify_patches(tile_min, tile_max, oil_pixels, patch_size, invalid_value=0):
+    invalid = (tile_min == invalid_value) & (tile_max == invalid_value)
+    empty = ~invalid & (oil_pixels == 0)
+    full = ~invalid & (oil_pixels == patch_size * patch_size)
+    return invalid, empty, full
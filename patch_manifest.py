@@ -0,0 +1,210 @@
+import os
+import glob
+import json
+import time
+import hashlib
+
+manifest_dir = "manifest"
+sources_file = "sources.json"
+# Bytes hashed per read
+hash_chunk = 16 * 1024 * 1024
+# Seconds before the lock of a task killed while hashing the sources is broken
+lock_seconds = 3600
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(hash_chunk), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Size, modification time and content hash of a source file. The hash of a previous
+# signature is reused while the size and modification time don't change, so the
+# sources are only hashed again when they are touched (a source touched without
+# changes keeps being up to date)
+def file_signature(path, previous=None):
+    stat = os.stat(path)
+    if (
+        previous is not None
+        and previous["size"] == stat.st_size
+        and previous["mtime"] == stat.st_mtime_ns
+    ):
+        return previous
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": file_hash(path)}
+
+
+def same_file(signature, path):
+    stat = os.stat(path)
+    return signature["size"] == stat.st_size and signature["mtime"] == stat.st_mtime_ns
+
+
+def read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def write_json(path, value):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+# Signature of the sources of a scene, shared by all the tasks of the scene on
+# <manifest path>/sources.json: the first task getting the lock hashes the sources
+# that changed and the rest wait for it, so a scene is hashed once and not by each of
+# the tasks working on it
+def sources_signature(path, sources):
+    os.makedirs(path, exist_ok=True)
+    signature_path = os.path.join(path, sources_file)
+    lock_path = signature_path + ".lock"
+    while True:
+        previous = read_json(signature_path, {})
+        if all(
+            source in previous and same_file(previous[source], source)
+            for source in sources
+        ):
+            return {source: previous[source] for source in sources}
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > lock_seconds:
+                    os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            time.sleep(1)
+            continue
+        try:
+            signature = {
+                source: file_signature(source, previous.get(source))
+                for source in sources
+            }
+            previous.update(signature)
+            write_json(signature_path, previous)
+        finally:
+            os.close(lock)
+            os.remove(lock_path)
+        return signature
+
+
+# Manifest directory of a builder for a scene, next to the output directory instead
+# of inside it (<dataset>/manifest/<output dir>/<builder>/<scene>) so the output
+# trees only hold patches (classification/ only has its class directories)
+def manifest_path(out_dir, builder, img_name):
+    out_dir = os.path.normpath(out_dir)
+    return os.path.join(
+        os.path.dirname(out_dir),
+        manifest_dir,
+        os.path.basename(out_dir),
+        builder,
+        img_name,
+    )
+
+
+def json_value(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+class SceneManifest:
+    # Outputs of a builder for a scene already written with the current sources and
+    # options. Every task (part) appends to its own file (<manifest path>/<part>.jsonl)
+    # a first line with the signature of the sources (hashes) and the options
+    # (patch_size, ...) followed by a line for every set of tiles written or
+    # the results of the whole scene. Only the parts whose signature matches the
+    # current one count, so the tiles of an edited source are built again
+    def __init__(self, out_dir, builder, img_name, sources, options, force=False):
+        self.path = manifest_path(out_dir, builder, img_name)
+        self.signature = {
+            "sources": sources_signature(self.path, sources),
+            "options": options,
+        }
+        self.opened = set()
+        self.parts = {} if force else self.load_parts()
+        self.parts = {
+            part: (signature, tiles, result)
+            for part, (signature, tiles, result) in self.parts.items()
+            if self.same_signature(signature)
+        }
+
+    def same_signature(self, signature):
+        return signature["options"] == self.signature["options"] and {
+            source: value["sha256"] for source, value in signature["sources"].items()
+        } == {
+            source: value["sha256"]
+            for source, value in self.signature["sources"].items()
+        }
+
+    def load_parts(self):
+        parts = {}
+        for path in glob.glob(os.path.join(self.path, "*.jsonl")):
+            with open(path) as f:
+                lines = f.read().splitlines()
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Last line of a task killed while writing it
+                    break
+            if not records:
+                continue
+            tiles = set()
+            result = None
+            for record in records[1:]:
+                tiles.update(record.get("tiles", []))
+                result = record.get("result", result)
+            part = os.path.basename(path)[: -len(".jsonl")]
+            parts[part] = (records[0], tiles, result)
+        return parts
+
+    # Tiles written by any part with the current signature
+    def done_tiles(self):
+        tiles = set()
+        for _, part_tiles, _ in self.parts.values():
+            tiles.update(part_tiles)
+        return tiles
+
+    # Results of the scene when it was completely built with the current signature
+    def result(self):
+        for _, _, result in self.parts.values():
+            if result is not None:
+                return result
+        return None
+
+    def append(self, part, record):
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, part + ".jsonl")
+        if part not in self.opened:
+            # The part is written again on its first record of the run, with the
+            # current signature and the tiles it already had when it matches (a part
+            # of other sources or options is dropped, and so is the last line of a
+            # killed task)
+            if part not in self.parts:
+                self.parts[part] = (self.signature, set(), None)
+            _, tiles, result = self.parts[part]
+            with open(path, "w") as f:
+                f.write(json.dumps(self.signature) + "\n")
+                if tiles:
+                    f.write(json.dumps({"tiles": sorted(tiles)}) + "\n")
+                if result is not None:
+                    f.write(json.dumps({"result": result}) + "\n")
+            self.opened.add(part)
+        with open(path, "a") as f:
+            f.write(json.dumps(record, default=json_value) + "\n")
+
+    def record_tiles(self, part, tiles):
+        tiles = [int(tile) for tile in tiles]
+        self.append(part, {"tiles": tiles})
+        self.parts[part][1].update(tiles)
+
+    def record_result(self, result):
+        result = [json_value(value) for value in result]
+        self.append("scene", {"result": result})
+        signature, tiles, _ = self.parts["scene"]
+        self.parts["scene"] = (signature, tiles, result)
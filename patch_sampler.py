@@ -0,0 +1,157 @@
+import os
+import random
+import numpy as np
+import pandas as pd
+
+from skimage.io import imread
+
+# Patches with at least this percentage of oil pixels are augmented, once for every
+# percent of oil
+min_percentage_oil = 10.0
+plan_file = "augmentation_plan.csv"
+
+
+# Patch counts of the scenes (counts/images CSVs) on a single table
+def load_image_counts(dst_path, img_names):
+    return pd.concat(
+        [
+            pd.read_csv(
+                os.path.join(dst_path, "counts", "images", img_name + ".csv"),
+                usecols=["patch_name", "total_pixels", "oil_pixels", "sea_pixels"],
+            )
+            for img_name in img_names
+        ],
+        ignore_index=True,
+    )
+
+
+# Number of augmentations of every patch: the rounded percentage of oil pixels for
+# the patches with at least min_percentage_oil, 0 for the rest
+def augmentation_counts(oil_pixels, total_pixels):
+    percentages = [
+        round(patch_oil_pixels / patch_total_pixels * 100, 2)
+        for patch_oil_pixels, patch_total_pixels in zip(oil_pixels, total_pixels)
+    ]
+    return np.array(
+        [
+            int(round(percentage, 0)) if percentage >= min_percentage_oil else 0
+            for percentage in percentages
+        ],
+        dtype=np.int64,
+    )
+
+
+# Number of augmentations of every patch so the oil pixels reach oil_fraction of all
+# the pixels, adding at most budget augmented patches. The patches are sorted by
+# their fraction of oil and, for every prefix of k patches with A oil pixels and B
+# pixels on the cumulative sums, replicating each of them s times reaches the target
+# when s = (oil_fraction * T - O) / (A - oil_fraction * B), T and O being the current
+# total and oil pixels. The largest prefix (most different patches) whose k * s
+# augmentations fit on the budget is kept, with the copies spread evenly over it
+def balance_augmentations(oil_pixels, total_pixels, oil_fraction, budget):
+    oil_pixels = np.asarray(oil_pixels, dtype=np.float64)
+    total_pixels = np.asarray(total_pixels, dtype=np.float64)
+    num_of_patches = np.zeros(len(oil_pixels), dtype=np.int64)
+    missing_oil = oil_fraction * total_pixels.sum() - oil_pixels.sum()
+    if missing_oil <= 0:
+        return num_of_patches
+
+    order = np.argsort(-(oil_pixels / total_pixels), kind="stable")
+    excess_oil = np.cumsum(oil_pixels[order]) - oil_fraction * np.cumsum(
+        total_pixels[order]
+    )
+    # Prefixes with a fraction of oil below the target can't reach it
+    scale = np.full(len(order), np.inf)
+    np.divide(missing_oil, excess_oil, out=scale, where=excess_oil > 0)
+    augmentations = scale * np.arange(1, len(order) + 1)
+    feasible = np.flatnonzero(augmentations <= budget)
+    if len(feasible) == 0:
+        # Without any prefix above the target no number of augmentations reaches
+        # it, replicating the patch with most oil only gets close to its fraction
+        if np.isfinite(augmentations.min()):
+            reachable = f"at least {int(np.ceil(augmentations.min()))} needed"
+        else:
+            reachable = (
+                "the patches only reach an oil fraction below "
+                f"{round(float((oil_pixels / total_pixels).max()), 4)}"
+            )
+        raise ValueError(
+            f"An oil fraction of {oil_fraction} can't be reached with {budget} "
+            f"augmented patches, {reachable}"
+        )
+    k = feasible[-1] + 1
+    total_augmentations = int(round(augmentations[k - 1]))
+    num_of_patches[order[:k]] = total_augmentations // k
+    num_of_patches[order[: total_augmentations % k]] += 1
+    return num_of_patches
+
+
+class AugmentedPatchSampler:
+    # Draws the patches with the same class balance than saving the _augNNN copies
+    # of build_augmentation_patches.py, without writing them: every patch is drawn
+    # with a weight of 1 + its number of augmentations and, when drawn, it is
+    # augmented (transform applied at read time) with probability
+    # augmentations / (1 + augmentations). An epoch has as many draws as patches
+    # plus augmented copies. Draws and transforms are seeded from (seed, epoch) so
+    # the runs are reproducible. The patches are read from the files or from a
+    # PatchDataset when given
+    def __init__(self, dst_path, patches, transform, seed=0, dataset=None):
+        self.dst_path = dst_path
+        self.names = patches["patch_name"].tolist()
+        if "num_of_patches" in patches:
+            self.augmentations = patches["num_of_patches"].to_numpy(np.int64)
+        else:
+            self.augmentations = augmentation_counts(
+                patches["oil_pixels"], patches["total_pixels"]
+            )
+        self.transform = transform
+        self.seed = seed
+        self.dataset = dataset
+        if dataset is not None:
+            positions = {name: i for i, name in enumerate(dataset.names)}
+            self.positions = [positions[name] for name in self.names]
+        copies = 1 + self.augmentations
+        self.weights = copies / copies.sum()
+        self.length = int(copies.sum())
+
+    def __len__(self):
+        return self.length
+
+    def read(self, index):
+        if self.dataset is not None:
+            image, label = self.dataset[self.positions[index]]
+            return np.array(image), np.array(label)
+        patch_name = self.names[index]
+        patch_image = imread(
+            os.path.join(self.dst_path, "features", "origin", patch_name + ".tif")
+        )
+        patch_label = imread(os.path.join(self.dst_path, "labels", patch_name + ".png"))
+        return patch_image, patch_label
+
+    # Patch name, image and label of a draw
+    def sample(self, index, draw_seed):
+        patch_image, patch_label = self.read(index)
+        augmentations = self.augmentations[index]
+        rng = np.random.default_rng(draw_seed)
+        if rng.random() < augmentations / (1 + augmentations):
+            # The transforms draw from the global random generators
+            random.seed(int(draw_seed))
+            np.random.seed(draw_seed)
+            transformed = self.transform(image=patch_image, mask=patch_label)
+            patch_image, patch_label = transformed["image"], transformed["mask"]
+        return self.names[index], patch_image, patch_label
+
+    # Patch indexes and seeds of the draws of an epoch
+    def draws(self, epoch=0):
+        rng = np.random.default_rng([self.seed, epoch])
+        indexes = rng.choice(len(self.names), size=self.length, p=self.weights)
+        draw_seeds = rng.integers(2**32, size=self.length, dtype=np.uint32)
+        return indexes, draw_seeds
+
+    def epoch(self, epoch=0):
+        indexes, draw_seeds = self.draws(epoch)
+        for index, draw_seed in zip(indexes, draw_seeds):
+            yield self.sample(index, draw_seed)
+
+    def __iter__(self):
+        return self.epoch()
@@ -0,0 +1,160 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+from patch_writer import PatchSink
+
+# Patches per shard file
+shard_size = 256
+shards_dir = "shards"
+index_dir = "index"
+index_columns = [
+    "patch_name",
+    "scene",
+    "index",
+    "x",
+    "y",
+    "shard",
+    "offset",
+    "total_pixels",
+    "oil_pixels",
+    "sea_pixels",
+    "invalid_patch",
+    "full_oil_patch",
+    "full_sea_patch",
+]
+
+
+class ShardSink(PatchSink):
+    # Packed output of the patches: each layer is saved in chunked .npy shards of
+    # shard_size patches (shards/<layer dir>/<prefix>_NNNNN.npy) and every patch gets
+    # a row on the index (shards/index/<prefix>.csv) with its scene, grid position,
+    # shard and offset, and the pixel counts and flags of its mask. The prefix must be
+    # unique per writer process (scene and task) so concurrent tasks don't collide
+    def __init__(
+        self,
+        out_dir,
+        prefix,
+        scene,
+        layer_dirs,
+        image_layer="image",
+        mask_layer="mask",
+        size=shard_size,
+    ):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.scene = scene
+        self.layer_dirs = layer_dirs
+        self.image_layer = image_layer
+        self.mask_layer = mask_layer
+        self.size = size
+        self.buffers = {}
+        self.count = 0
+        self.shard = 0
+        self.index = {column: [] for column in index_columns}
+        for layer_dir in layer_dirs.values():
+            os.makedirs(os.path.join(out_dir, layer_dir), exist_ok=True)
+        os.makedirs(os.path.join(out_dir, index_dir), exist_ok=True)
+
+    def shard_name(self):
+        return f"{self.prefix}_{self.shard:05d}.npy"
+
+    def write(self, patch_name, layers, position):
+        for layer in self.layer_dirs:
+            patch = layers[layer]
+            if layer not in self.buffers:
+                self.buffers[layer] = np.empty((self.size,) + patch.shape, patch.dtype)
+            self.buffers[layer][self.count] = patch
+        index, x, y = position
+        mask_patch = layers[self.mask_layer]
+        image_patch = layers[self.image_layer]
+        total_pixels = mask_patch.size
+        oil_pixels = int(np.count_nonzero(mask_patch == 1))
+        sea_pixels = int(np.count_nonzero(mask_patch == 0))
+        row = {
+            "patch_name": patch_name,
+            "scene": self.scene,
+            "index": index,
+            "x": x,
+            "y": y,
+            "shard": self.shard_name(),
+            "offset": self.count,
+            "total_pixels": total_pixels,
+            "oil_pixels": oil_pixels,
+            "sea_pixels": sea_pixels,
+            # Same flags than count_patches_pixels.py
+            "invalid_patch": int(
+                image_patch.min() == image_patch.max() and image_patch.max() == 1
+            ),
+            "full_oil_patch": int(oil_pixels == total_pixels),
+            "full_sea_patch": int(sea_pixels == total_pixels),
+        }
+        for column in index_columns:
+            self.index[column].append(row[column])
+        self.count = self.count + 1
+        if self.count == self.size:
+            self.flush()
+
+    # Save the patches buffered on the current shard of every layer
+    def flush(self):
+        if self.count == 0:
+            return
+        for layer, layer_dir in self.layer_dirs.items():
+            path = os.path.join(self.out_dir, layer_dir, self.shard_name())
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, self.buffers[layer][: self.count])
+            os.replace(path + ".tmp", path)
+        self.shard = self.shard + 1
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        pd.DataFrame.from_dict(self.index).to_csv(
+            os.path.join(self.out_dir, index_dir, self.prefix + ".csv"), index=False
+        )
+
+
+# Index of the packed patches, of all the scenes or of the given one. The indexes
+# left by previous builds with other tasks or workers (other prefixes) may hold the
+# same patches again, every patch is taken from the newest index holding it
+def load_shard_index(out_dir, scene=None):
+    pattern = "*.csv" if scene is None else f"{scene}*.csv"
+    paths = sorted(glob.glob(os.path.join(out_dir, index_dir, pattern)))
+    if not paths:
+        return pd.DataFrame(columns=index_columns)
+    indexes = [pd.read_csv(path) for path in paths]
+    modified = np.repeat(
+        [os.path.getmtime(path) for path in paths], [len(rows) for rows in indexes]
+    )
+    index = pd.concat(indexes, ignore_index=True)
+    newest = (
+        index.assign(modified=modified)
+        .sort_values("modified", kind="stable")
+        .drop_duplicates("patch_name", keep="last")
+        .index
+    )
+    index = index.loc[newest.sort_values()]
+    if scene is not None:
+        index = index[index["scene"] == scene]
+    return index.reset_index(drop=True)
+
+
+# Patches of a layer for the given index rows, every shard is opened (memory mapped)
+# once and the patches are returned in the order of the rows. When out is given the
+# patches are copied into it (another memory mapped array) instead of a new array
+def read_shard_patches(out_dir, layer_dir, index, out=None):
+    patches = out
+    for shard, rows in index.groupby("shard", sort=False):
+        data = np.load(os.path.join(out_dir, layer_dir, shard), mmap_mode="r")
+        if patches is None:
+            patches = np.empty((len(index),) + data.shape[1:], data.dtype)
+        positions = index.index.get_indexer(rows.index)
+        patches[positions] = data[rows["offset"].to_numpy()]
+    return patches
+
+
+# Shape and dtype of the patches of a layer, read from the header of a shard
+def shard_patch_format(out_dir, layer_dir, shard):
+    data = np.load(os.path.join(out_dir, layer_dir, shard), mmap_mode="r")
+    return data.shape[1:], data.dtype
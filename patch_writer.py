@@ -0,0 +1,158 @@
+import os
+import numpy as np
+import rasterio
+
+from skimage.io import imsave
+from PIL import Image
+from tqdm import tqdm
+
+from patch_figures import figure_image
+from patch_grid import grid_size, patch_rows
+
+
+# Scale a patch between 0 and 1 with the global min/max of its scene
+def scaler(min_value, max_value):
+    def scale(patch):
+        return (patch - min_value) / (max_value - min_value)
+
+    return scale
+
+
+# Mark all pixels on the mask above 0 as oil
+def binary_mask(patch):
+    mask_patch = patch.astype(np.uint8)
+    mask_patch[mask_patch > 0] = 1
+    return mask_patch
+
+
+class PatchSource:
+    # Layer of the patches read by windows from a scene (image, mask or texture) and
+    # the transform applied to every patch read
+    def __init__(self, reader, transform=None):
+        self.reader = reader
+        self.transform = transform
+
+    def read(self, x, y, patch_size):
+        patch = self.reader.read_tile(x, y, patch_size)
+        if self.transform is not None:
+            patch = self.transform(patch)
+        return patch
+
+
+class PatchSink:
+    # Output of the patch writer, receives every kept patch with the layers read and
+    # its (index, x, y) position on the grid
+    def write(self, patch_name, layers, position):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ImageSink(PatchSink):
+    # Save a layer of every patch as an image file (TIFF features, PNG labels)
+    def __init__(self, layer, out_dir, extension=".tif"):
+        self.layer = layer
+        self.out_dir = out_dir
+        self.extension = extension
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, patch_name, layers, position):
+        imsave(
+            os.path.join(self.out_dir, patch_name + self.extension),
+            layers[self.layer],
+            check_contrast=False,
+        )
+
+
+class BandsSink(PatchSink):
+    # Save a multi-band layer (bands, height, width) of every patch as a GeoTIFF with
+    # a band per layer (separate planes, no photometric interpretation), so it reads
+    # back as (bands, height, width) with rasterio or tifffile whatever the number of
+    # bands (imsave writes 3 or 4 bands as RGB(A) instead)
+    def __init__(self, layer, out_dir):
+        self.layer = layer
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, patch_name, layers, position):
+        patch = layers[self.layer]
+        with rasterio.open(
+            os.path.join(self.out_dir, patch_name + ".tif"),
+            "w",
+            driver="GTiff",
+            width=patch.shape[2],
+            height=patch.shape[1],
+            count=patch.shape[0],
+            dtype=patch.dtype,
+            interleave="band",
+            photometric="minisblack",
+        ) as dataset:
+            dataset.write(patch)
+
+
+class PreviewSink(PatchSink):
+    # Save a scaled layer in png for visualization
+    def __init__(self, layer, out_dir):
+        self.layer = layer
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, patch_name, layers, position):
+        image_to_save = Image.fromarray((layers[self.layer] * 255).astype(np.int16))
+        image_to_save.save(os.path.join(self.out_dir, patch_name + ".png"))
+
+
+class FigureSink(PatchSink):
+    # Save a figure with the image and mask patches, composited with PIL (no
+    # matplotlib figure per patch), on a fixed file name when given
+    def __init__(self, out_dir, image_layer="image", mask_layer="mask", fname=None):
+        self.out_dir = out_dir
+        self.image_layer = image_layer
+        self.mask_layer = mask_layer
+        self.fname = fname
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, patch_name, layers, position):
+        figure = figure_image(
+            patch_name,
+            [layers[self.image_layer], layers[self.mask_layer]],
+            ["Image patch", "Mask patch"],
+        )
+        figure.save(os.path.join(self.out_dir, (self.fname or patch_name) + ".png"))
+
+
+class PatchWriter:
+    # Single traversal of the patch grid: for every grid row the band of blocks of
+    # each source is read once, then every kept patch is read from each source once
+    # and sent to all the sinks. Adding a layer (texture) costs its own reads only,
+    # not another traversal of the grid with the validity checks
+    def __init__(self, sources, sinks, patch_size, name_format):
+        self.sources = sources
+        self.sinks = sinks
+        self.patch_size = patch_size
+        self.name_format = name_format
+
+    def write_row(self, y, row):
+        for source in self.sources.values():
+            source.reader.prefetch_row(y, row, self.patch_size)
+        for index, x in row:
+            layers = {
+                key: source.read(x, y, self.patch_size)
+                for key, source in self.sources.items()
+            }
+            patch_name = self.name_format.format(index=index)
+            for sink in self.sinks:
+                sink.write(patch_name, layers, (index, x, y))
+
+    def write(self, patches_indexes, image_width, image_height):
+        _, count_y = grid_size(image_width, image_height, self.patch_size)
+        rows = patch_rows(patches_indexes, image_width, image_height, self.patch_size)
+        for y, row in tqdm(rows, total=count_y):
+            self.write_row(y, row)
+
+    def close(self):
+        for source in self.sources.values():
+            source.reader.close()
+        for sink in self.sinks:
+            sink.close()
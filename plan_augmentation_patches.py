@@ -0,0 +1,81 @@
+import os
+import argparse
+
+from patch_sampler import balance_augmentations, load_image_counts, plan_file
+
+# Directories configuration
+home_path = os.path.expanduser("~")
+data_path = os.path.join(home_path, "data", "cimat")
+src_path = os.path.join(data_path, "dataset-cimat")
+dst_path = os.path.join(data_path, "dataset-cimat", "segmentation")
+
+parser = argparse.ArgumentParser(
+    prog="PlanAugmentation",
+    description="Plan the augmentations of the patches to reach an oil:sea ratio",
+)
+parser.add_argument(
+    "--oil-sea-ratio",
+    type=float,
+    default=1.0,
+    help="Oil pixels per sea pixel to reach after the augmentation",
+)
+parser.add_argument(
+    "--budget",
+    type=int,
+    help="Maximum number of augmented patches (default the number of patches)",
+)
+parser.add_argument(
+    "--output",
+    default=os.path.join(dst_path, "counts", plan_file),
+    help="Plan file read by build_augmentation_patches.py --plan",
+)
+args = parser.parse_args()
+print(args)
+
+# Open list of patches counts of all the images
+img_names = [
+    fname.split(".")[0] for fname in os.listdir(os.path.join(src_path, "image_norm"))
+]
+mask_images_patches = load_image_counts(dst_path, img_names)
+total_mask_patches = len(mask_images_patches)
+print("Mask images patches: ", total_mask_patches)
+total_oil_pixels = mask_images_patches["oil_pixels"].sum()
+total_sea_pixels = mask_images_patches["sea_pixels"].sum()
+total_pixels = total_oil_pixels + total_sea_pixels
+print(
+    f"Initial total pixel counts, oil: {total_oil_pixels}, sea: {total_sea_pixels}, total: {total_pixels}"
+)
+print(
+    f"Percentage of pixel counts, oil: {round(total_oil_pixels/total_pixels,2)}, sea: {round(total_sea_pixels/total_pixels,2)}"
+)
+
+# Solve the number of augmentations of every patch
+oil_fraction = args.oil_sea_ratio / (1 + args.oil_sea_ratio)
+budget = args.budget if args.budget is not None else total_mask_patches
+mask_images_patches["num_of_patches"] = balance_augmentations(
+    mask_images_patches["oil_pixels"],
+    mask_images_patches["total_pixels"],
+    oil_fraction,
+    budget,
+)
+plan_df = mask_images_patches[mask_images_patches["num_of_patches"] > 0]
+plan_df = plan_df.sort_values("oil_pixels", ascending=False)
+os.makedirs(os.path.dirname(args.output), exist_ok=True)
+plan_df.to_csv(args.output, index=False)
+
+# Expected balance after the augmentation
+augmented_oil_pixels = int((plan_df["oil_pixels"] * plan_df["num_of_patches"]).sum())
+augmented_sea_pixels = int((plan_df["sea_pixels"] * plan_df["num_of_patches"]).sum())
+total_oil_pixels += augmented_oil_pixels
+total_sea_pixels += augmented_sea_pixels
+total_pixels = total_oil_pixels + total_sea_pixels
+print(
+    f"Planned augmentations: {int(plan_df['num_of_patches'].sum())} of {len(plan_df)} patches, budget: {budget}"
+)
+print(
+    f"Planned total pixel counts, oil: {total_oil_pixels}, sea: {total_sea_pixels}, total: {total_pixels}"
+)
+print(
+    f"Percentage of pixel counts, oil: {round(total_oil_pixels/total_pixels,2)}, sea: {round(total_sea_pixels/total_pixels,2)}"
+)
+print("Done!")
@@ -0,0 +1,129 @@
+import os
+import argparse
+import rasterio
+
+from rasterio.enums import Resampling
+
+from raster_io import iter_row_windows
+from task_executor import map_workers
+
+# Directories configuration
+home_path = os.path.expanduser("~")
+data_path = os.path.join(home_path, "data", "cimat")
+src_path = os.path.join(data_path, "dataset-cimat")
+# Sentinel-1 scenes of the NOAA dataset, rendered by geoLocal.py
+noaa_path = os.path.join(data_path, "dataset-noaa")
+noaa_dir = os.path.join("sentinel1", "TIFF")
+# Initial configuration
+img_dirs = ["image_norm", "image_tiff", "tiff"]
+txt_path = "textures"
+# Temporary files of the scenes being rewritten, on their own directory of the dataset
+# (same filesystem) so the scene directories only ever list the scenes
+tmp_dir = "tmp_tiled"
+patch_size = 224
+# Overviews are added down to this size on the largest side
+min_overview_size = 256
+
+
+# Whether a scene is already tiled with square blocks of block_size
+def is_tiled(path, block_size):
+    with rasterio.open(path) as dataset:
+        return dataset.profile.get("tiled", False) and all(
+            block_shape == (block_size, block_size)
+            for block_shape in dataset.block_shapes
+        )
+
+
+# Rewrite a scene as an internally tiled GeoTIFF with block_size blocks (aligned to
+# the patch grid), lossless compression and overviews. The scene is copied by bands
+# of block rows into a temporary file of tmp_path that replaces it, with the same
+# values, georef and tags
+def tile_scene(path, tmp_path, block_size, force=False):
+    if not force and is_tiled(path, block_size):
+        print(f"{path} already tiled")
+        return False
+    os.makedirs(tmp_path, exist_ok=True)
+    tmp_path = os.path.join(tmp_path, f"{os.getpid()}_{os.path.basename(path)}")
+    with rasterio.open(path) as src:
+        profile = src.profile
+        profile.update(
+            driver="GTiff",
+            tiled=True,
+            blockxsize=block_size,
+            blockysize=block_size,
+            compress="deflate",
+            # Horizontal predictor for the integer scenes only, the floating point
+            # one can't be read by tifffile (skimage) without imagecodecs
+            predictor=1 if src.dtypes[0].startswith("float") else 2,
+            bigtiff="if_safer",
+        )
+        with rasterio.open(tmp_path, "w", **profile) as dst:
+            dst.update_tags(**src.tags())
+            for band in range(1, src.count + 1):
+                dst.update_tags(band, **src.tags(band))
+            for window in iter_row_windows(src, rows=block_size * 4):
+                dst.write(src.read(window=window), window=window)
+            factors = []
+            factor = 2
+            while max(src.width, src.height) // factor >= min_overview_size:
+                factors.append(factor)
+                factor = factor * 2
+            if factors:
+                dst.build_overviews(factors, Resampling.average)
+                dst.update_tags(ns="rio_overview", resampling="average")
+    os.replace(tmp_path, path)
+    print(f"{path} tiled, overviews: {factors}")
+    return True
+
+
+parser = argparse.ArgumentParser(
+    prog="PrepareTiledScenes",
+    description="Rewrite the scenes as tiled GeoTIFFs with blocks of the patch size",
+)
+parser.add_argument("--img-dir", action="append", help="Scene directories to process")
+parser.add_argument(
+    "--textures", action="store_true", help="Also process the texture directories"
+)
+parser.add_argument(
+    "--noaa",
+    action="store_true",
+    help="Also process the Sentinel-1 scenes of dataset-noaa rendered by geoLocal.py",
+)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Scenes rewritten at the same time"
+)
+parser.add_argument(
+    "--force", action="store_true", help="Rewrite the scenes already tiled"
+)
+args = parser.parse_args()
+print(args)
+
+# Scene directories as (dataset, directory)
+scene_dirs = [(src_path, scene_dir) for scene_dir in args.img_dir or img_dirs]
+if args.textures:
+    for texture_dir in sorted(os.listdir(os.path.join(src_path, txt_path))):
+        scene_dirs.append((src_path, os.path.join(txt_path, texture_dir)))
+if args.noaa:
+    scene_dirs.append((noaa_path, noaa_dir))
+
+scenes = []
+for dataset_path, scene_dir in scene_dirs:
+    if not os.path.isdir(os.path.join(dataset_path, scene_dir)):
+        print(f"Skipping {scene_dir}, directory not found")
+        continue
+    for fname in sorted(os.listdir(os.path.join(dataset_path, scene_dir))):
+        if fname.endswith(".tif"):
+            scenes.append(
+                (
+                    os.path.join(dataset_path, scene_dir, fname),
+                    os.path.join(dataset_path, tmp_dir),
+                )
+            )
+
+tiled = map_workers(
+    tile_scene,
+    [(path, tmp_path, patch_size, args.force) for path, tmp_path in scenes],
+    args.workers,
+)
+print(f"Scenes tiled: {sum(tiled)} of {len(scenes)}")
+print("Done!")
@@ -0,0 +1,245 @@
+import os
+import zlib
+import struct
+import numpy as np
+import rasterio
+
+from multiprocessing.shared_memory import SharedMemory
+from rasterio.windows import Window
+
+# Rows read per chunk when a band has to be streamed (rounded to the block height)
+stream_rows = 1024
+
+
+# Row bands covering the whole band, aligned to the internal block height so every
+# block is decoded only once
+def iter_row_windows(dataset, band=1, rows=stream_rows):
+    block_height, _ = dataset.block_shapes[band - 1]
+    rows = max(block_height, (rows // block_height) * block_height)
+    for row_off in range(0, dataset.height, rows):
+        yield Window(0, row_off, dataset.width, min(rows, dataset.height - row_off))
+
+
+# Whether the GDAL statistics tags of a band hold its exact min and max: computed
+# over all the pixels (not approximate), with no nodata value (the tags leave the
+# nodata pixels out while the scaling uses every pixel of the band) and not read from
+# a .aux.xml sidecar older than the raster
+def exact_statistics(dataset, band, tags):
+    if "STATISTICS_MINIMUM" not in tags or "STATISTICS_MAXIMUM" not in tags:
+        return False
+    if tags.get("STATISTICS_APPROXIMATE", "NO").upper() == "YES":
+        return False
+    if dataset.nodatavals[band - 1] is not None:
+        return False
+    if float(tags.get("STATISTICS_VALID_PERCENT", 100)) != 100:
+        return False
+    aux_path = dataset.name + ".aux.xml"
+    return not os.path.exists(aux_path) or os.path.getmtime(
+        aux_path
+    ) >= os.path.getmtime(dataset.name)
+
+
+# Global min and max of a band without loading the whole raster in memory. The GDAL
+# statistics tags are used when they are exact, otherwise the band is streamed in
+# block aligned row bands
+def band_min_max(dataset, band=1):
+    dtype = np.dtype(dataset.dtypes[band - 1]).type
+    tags = dataset.tags(band)
+    if exact_statistics(dataset, band, tags):
+        return dtype(float(tags["STATISTICS_MINIMUM"])), dtype(
+            float(tags["STATISTICS_MAXIMUM"])
+        )
+    min_band = None
+    max_band = None
+    for window in iter_row_windows(dataset, band):
+        data = dataset.read(band, window=window)
+        min_data = data.min()
+        max_data = data.max()
+        min_band = min_data if min_band is None else min(min_band, min_data)
+        max_band = max_data if max_band is None else max(max_band, max_data)
+    return dtype(min_band), dtype(max_band)
+
+
+class TileReader:
+    # Windowed reader for patch tiles. Reads are expanded to the internal block layout
+    # of the raster and the last region read is kept, so the tiles of a grid row are
+    # sliced from a single band of blocks instead of loading the whole scene. With a
+    # list of bands every tile has all of them, (bands, height, width), from one read
+    def __init__(self, path, band=1):
+        self.path = path
+        self.band = band
+        self.dataset = rasterio.open(path)
+        self.width = self.dataset.width
+        self.height = self.dataset.height
+        first_band = band[0] if isinstance(band, list) else band
+        self.block_height, self.block_width = self.dataset.block_shapes[first_band - 1]
+        self.region = None
+        self.region_window = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.region = None
+        self.dataset.close()
+
+    # Smallest block aligned window containing the requested one
+    def aligned_window(self, x, y, width, height):
+        col_off = (x // self.block_width) * self.block_width
+        row_off = (y // self.block_height) * self.block_height
+        col_end = min(
+            -(-(x + width) // self.block_width) * self.block_width, self.width
+        )
+        row_end = min(
+            -(-(y + height) // self.block_height) * self.block_height, self.height
+        )
+        return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+    # Read the blocks covering the given region, following tiles are sliced from it
+    def prefetch(self, x, y, width, height):
+        self.region_window = self.aligned_window(x, y, width, height)
+        self.region = self.dataset.read(self.band, window=self.region_window)
+
+    def contains(self, x, y, width, height):
+        if self.region_window is None:
+            return False
+        window = self.region_window
+        return (
+            x >= window.col_off
+            and y >= window.row_off
+            and x + width <= window.col_off + window.width
+            and y + height <= window.row_off + window.height
+        )
+
+    def read_tile(self, x, y, patch_size):
+        if not self.contains(x, y, patch_size, patch_size):
+            self.prefetch(x, y, patch_size, patch_size)
+        x = int(x - self.region_window.col_off)
+        y = int(y - self.region_window.row_off)
+        return self.region[..., y : y + patch_size, x : x + patch_size]
+
+    # Full width band of rows starting at the image row y
+    def read_rows(self, y, height):
+        if not self.contains(0, y, self.width, height):
+            self.prefetch(0, y, self.width, height)
+        y = int(y - self.region_window.row_off)
+        return self.region[..., y : y + height, :]
+
+    # Prefetch the band of rows holding all the (index, x) patches of a grid row,
+    # unless the region already read holds it
+    def prefetch_row(self, y, row, patch_size):
+        x_start = min(x for _, x in row)
+        x_end = max(x for _, x in row) + patch_size
+        if not self.contains(x_start, y, x_end - x_start, patch_size):
+            self.prefetch(x_start, y, x_end - x_start, patch_size)
+
+    def min_max(self):
+        return band_min_max(self.dataset, self.band)
+
+
+class SharedBand:
+    # Band of a raster decoded once into shared memory for the worker processes of a
+    # scene. PNG masks can't be read by windows without decoding all the rows above,
+    # so every worker reading its own tiles would decode the mask again. Pickled by
+    # the name of the shared block, the process that created it must unlink it
+    def __init__(self, path, band=1):
+        self.path = path
+        self.band = band
+        with rasterio.open(path) as dataset:
+            self.shape = (dataset.height, dataset.width)
+            self.dtype = np.dtype(dataset.dtypes[band - 1])
+            self.memory = SharedMemory(
+                create=True,
+                size=max(1, self.shape[0] * self.shape[1] * self.dtype.itemsize),
+            )
+            dataset.read(band, out=self.array())
+        self.name = self.memory.name
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["memory"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memory = SharedMemory(name=self.name)
+
+    def array(self):
+        return np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+
+    def reader(self):
+        return SharedTileReader(self)
+
+    def unlink(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SharedTileReader(TileReader):
+    # Tile reader on a shared band, the whole band is the region read so every tile
+    # is sliced from it without any decoding
+    def __init__(self, shared_band):
+        self.path = shared_band.path
+        self.band = shared_band.band
+        self.dataset = None
+        self.height, self.width = shared_band.shape
+        self.block_height, self.block_width = shared_band.shape
+        self.shared_band = shared_band
+        self.region = shared_band.array()
+        self.region_window = Window(0, 0, self.width, self.height)
+
+    def close(self):
+        self.region = None
+
+    def min_max(self):
+        return self.region.min(), self.region.max()
+
+
+class BitMaskWriter:
+    # Streaming writer of a 1 bit grayscale PNG (values 0 and 1, read as uint8 by
+    # GDAL and 8 times smaller to decode than a byte per pixel). Every band of rows is
+    # packed 8 pixels per byte and compressed as it is written, so the mask is never
+    # held whole in memory
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.compressor = zlib.compressobj(9)
+        self.file = open(path, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        # Bit depth 1, grayscale, no interlacing
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0))
+
+    def chunk(self, chunk_type, data):
+        self.file.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    # Write the next rows, pixels not 0 are saved as 1
+    def write_rows(self, rows):
+        packed = np.packbits(rows != 0, axis=1)
+        # Every row starts with its filter type (0, none)
+        scanlines = np.zeros((len(packed), packed.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 1:] = packed
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self.chunk(b"IDAT", data)
+        self.rows = self.rows + len(rows)
+
+    def close(self):
+        self.chunk(b"IDAT", self.compressor.flush())
+        self.chunk(b"IEND", b"")
+        self.file.close()
+        if self.rows != self.height:
+            raise ValueError(
+                f"{self.path} has {self.rows} rows written instead of {self.height}"
+            )
+
+
+# Height and width of a raster read from its header only
+def raster_shape(path):
+    with rasterio.open(path) as dataset:
+        return dataset.height, dataset.width
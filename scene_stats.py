@@ -0,0 +1,138 @@
+import os
+import numpy as np
+
+from patch_grid import band_reduce, grid_size, oil_pixels_reduce, patch_offset
+from raster_io import TileReader, stream_rows
+
+# Sidecars are kept apart from the scenes so the directory listings used to pick the
+# scene of each SLURM array task are not altered
+stats_dir = "stats"
+histogram_bins = 256
+
+
+def stats_path(src_path, img_dir, img_name):
+    return os.path.join(src_path, stats_dir, img_dir, img_name + ".npz")
+
+
+# Statistics of a scene computed streaming the raster in row bands: global min/max
+# and histogram, per patch min/max (and zero map) and, when a mask is given, the oil
+# pixels of every patch. The global min/max are needed for the histogram edges so
+# they are taken first from the GDAL tags or a streamed pass
+def compute_scene_stats(image_path, mask_path, patch_size, bins=histogram_bins):
+    image_reader = TileReader(image_path)
+    mask_reader = TileReader(mask_path) if mask_path is not None else None
+    image_height, image_width = image_reader.height, image_reader.width
+    if mask_reader is not None and (
+        mask_reader.height != image_height or mask_reader.width != image_width
+    ):
+        raise ValueError(
+            f"Image and mask must have the same dimensions: {image_path}, {mask_path}"
+        )
+    min_image, max_image = image_reader.min_max()
+    bin_edges = np.linspace(float(min_image), float(max_image), bins + 1)
+    histogram = np.zeros(bins, dtype=np.int64)
+
+    count_x, count_y = grid_size(image_width, image_height, patch_size)
+    tile_min = np.empty((count_y, count_x), dtype=min_image.dtype)
+    tile_max = np.empty((count_y, count_x), dtype=max_image.dtype)
+    oil_pixels = np.zeros((count_y, count_x), dtype=np.int64)
+    # The regular grid rows are streamed in bands of several grid rows and reduced
+    # with block views, the clamped last grid row is read as its own band. Rows below
+    # the regular bands are added to the histogram separately so every pixel is
+    # counted once
+    rows_per_band = max(1, stream_rows // patch_size)
+    bands = [
+        (j, min(rows_per_band, count_y - 1 - j))
+        for j in range(0, count_y - 1, rows_per_band)
+    ]
+    bands.append((count_y - 1, 1))
+    histogram_end = patch_size * (count_y - 1)
+    for j, k in bands:
+        y = patch_offset(j, image_height, patch_size)
+        band = image_reader.read_rows(y, k * patch_size)
+        tile_min[j : j + k] = band_reduce(band, patch_size, np.min)
+        tile_max[j : j + k] = band_reduce(band, patch_size, np.max)
+        if j < count_y - 1:
+            histogram += np.histogram(band, bins=bin_edges)[0]
+        if mask_reader is not None:
+            mask_band = mask_reader.read_rows(y, k * patch_size)
+            oil_pixels[j : j + k] = band_reduce(
+                mask_band, patch_size, oil_pixels_reduce
+            )
+    if histogram_end < image_height:
+        band = image_reader.read_rows(histogram_end, image_height - histogram_end)
+        histogram += np.histogram(band, bins=bin_edges)[0]
+    image_reader.close()
+    if mask_reader is not None:
+        mask_reader.close()
+
+    stats = {
+        "width": image_width,
+        "height": image_height,
+        "patch_size": patch_size,
+        "min": min_image,
+        "max": max_image,
+        "histogram": histogram,
+        "bin_edges": bin_edges,
+        "tile_min": tile_min,
+        "tile_max": tile_max,
+        "zero_patches": (tile_min == 0) & (tile_max == 0),
+    }
+    if mask_reader is not None:
+        stats["oil_pixels"] = oil_pixels
+    return stats
+
+
+def save_scene_stats(path, stats):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **stats)
+    os.replace(tmp_path, path)
+
+
+# Load the sidecar of a scene, None when it doesn't exist, it was computed with
+# another patch size or the sources were modified after it was written
+def load_scene_stats(src_path, img_dir, img_name, patch_size, mask_dir=None):
+    path = stats_path(src_path, img_dir, img_name)
+    if not os.path.exists(path):
+        return None
+    sources = [os.path.join(src_path, img_dir, img_name + ".tif")]
+    if mask_dir is not None:
+        sources.append(os.path.join(src_path, mask_dir, img_name + ".png"))
+    stats_mtime = os.path.getmtime(path)
+    if any(os.path.getmtime(source) > stats_mtime for source in sources):
+        return None
+    with np.load(path) as data:
+        stats = {key: data[key][()] for key in data.files}
+    if stats["patch_size"] != patch_size:
+        return None
+    if mask_dir is not None and "oil_pixels" not in stats:
+        return None
+    return stats
+
+
+# Sidecar of the scene, computed in memory (streaming) when it is not available
+def get_scene_stats(src_path, img_dir, img_name, patch_size, mask_dir=None):
+    stats = load_scene_stats(src_path, img_dir, img_name, patch_size, mask_dir)
+    if stats is None:
+        print(f"Statistics sidecar not found for {img_dir}/{img_name}, computing it")
+        stats = compute_scene_stats(
+            os.path.join(src_path, img_dir, img_name + ".tif"),
+            (
+                os.path.join(src_path, mask_dir, img_name + ".png")
+                if mask_dir is not None
+                else None
+            ),
+            patch_size,
+        )
+    return stats
+
+
+# Global min and max of a scene from its sidecar, falling back to the reader
+def scene_min_max(src_path, img_dir, img_name, reader):
+    path = stats_path(src_path, img_dir, img_name)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(reader.path):
+        with np.load(path) as data:
+            return data["min"][()], data["max"][()]
+    return reader.min_max()
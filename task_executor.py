@@ -0,0 +1,46 @@
+import os
+import multiprocessing
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+# SLURM task of the process as (ntasks, procid), a single task outside SLURM
+def slurm_task():
+    ntasks = int(os.getenv("SLURM_NTASKS") or 1)
+    procid = int(os.getenv("SLURM_PROCID") or 0)
+    return ntasks, procid
+
+
+# Scene files to process: the one of the SLURM array task or, outside an array, all
+# the scenes of the directory
+def task_scenes(src_dir):
+    fnames = os.listdir(src_dir)
+    slurm_array_task_id = os.getenv("SLURM_ARRAY_TASK_ID")
+    if slurm_array_task_id:
+        return [fnames[int(slurm_array_task_id) - 1]]
+    return fnames
+
+
+# Call func with every tuple of arguments, on a pool of forked worker processes
+# when workers > 1 (the module level functions of the scripts and the shared bands
+# are inherited by the workers), returning the results in the order of the
+# arguments
+def map_workers(func, args_list, workers=1):
+    args_list = list(args_list)
+    if workers <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(args_list)),
+        mp_context=multiprocessing.get_context("fork"),
+    ) as executor:
+        return list(executor.map(func, *zip(*args_list)))
+
+
+# Results of the scenes on a table, a row per scene with its file name on the image
+# column followed by the values returned for it
+def results_table(fnames, results, columns):
+    return pd.DataFrame(
+        [(fname,) + tuple(result) for fname, result in zip(fnames, results)],
+        columns=["image"] + columns,
+    )
@@ -0,0 +1,124 @@
+import os
+import time
+import socket
+import sqlite3
+
+queue_dir = "queue"
+# Seconds before the range leased by a task that didn't complete it (killed,
+# preempted) is handed to another task
+lease_seconds = 3600
+
+
+# Patch indexes of a task on the static split of the grid between ntasks tasks: a
+# contiguous slice for every task, the remaining patches one per task from the first
+def static_patches(total_patches, ntasks, procid):
+    patches_per_task = total_patches // ntasks
+    missing_patches_per_task = total_patches % ntasks
+    patches_indexes = [
+        procid * patches_per_task + index for index in range(patches_per_task)
+    ]
+    if procid < missing_patches_per_task:
+        patches_indexes.append(ntasks * patches_per_task + procid)
+    return patches_indexes
+
+
+# Run sharing the queues: the SLURM job or, outside SLURM, the local run (set when
+# the script imports this module, so its forked workers share it)
+run_id = (
+    os.getenv("SLURM_ARRAY_JOB_ID")
+    or os.getenv("SLURM_JOB_ID")
+    or f"local_{time.strftime('%Y%m%d%H%M%S')}_{os.getpid()}"
+)
+
+
+# Queue database of a scene, shared by the tasks of the same run (a new job or local
+# run starts a new queue, a requeued task resumes the one of its job)
+def queue_path(dst_path, name, img_name):
+    return os.path.join(dst_path, queue_dir, f"{run_id}_{name}_{img_name}.sqlite")
+
+
+# Name of the task holding a lease
+def task_owner(procid):
+    return f"{socket.gethostname()}:{os.getpid()}:{procid}"
+
+
+class WorkQueue:
+    # Lease table on SQLite to hand out ranges of patches on demand to the tasks of
+    # a run: every task adds the ranges of its scene (ignored when already added),
+    # then leases the first range not done nor leased (or with an expired lease),
+    # processes it and marks it as done once saved before leasing the next one. The
+    # tasks that land on cheap ranges (invalid regions) just take more of them
+    def __init__(self, path, lease_seconds=lease_seconds):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Autocommit, the transactions are opened explicitly. Hundreds of tasks
+        # share the database so a lock can take a while to get
+        self.connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ranges ("
+            "scene TEXT, start INTEGER, stop INTEGER, owner TEXT, leased_at REAL, "
+            "done INTEGER DEFAULT 0, PRIMARY KEY (scene, start))"
+        )
+
+    def transaction(self, statements):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements(self.connection)
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return result
+
+    # Add the ranges of range_size patches covering the total patches of a scene
+    def add(self, scene, total_patches, range_size):
+        rows = [
+            (scene, start, min(start + range_size, total_patches))
+            for start in range(0, total_patches, range_size)
+        ]
+        self.transaction(
+            lambda connection: connection.executemany(
+                "INSERT OR IGNORE INTO ranges (scene, start, stop) VALUES (?, ?, ?)",
+                rows,
+            )
+        )
+
+    # Lease the next pending range, (rowid, scene, start, stop) or None when there
+    # are no ranges left
+    def lease(self, owner):
+        def lease_range(connection):
+            now = time.time()
+            row = connection.execute(
+                "SELECT rowid, scene, start, stop FROM ranges WHERE done = 0 AND "
+                "(owner IS NULL OR leased_at < ?) ORDER BY rowid LIMIT 1",
+                (now - self.lease_seconds,),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE ranges SET owner = ?, leased_at = ? WHERE rowid = ?",
+                    (owner, now, row[0]),
+                )
+            return row
+
+        return self.transaction(lease_range)
+
+    def complete(self, rowid):
+        self.transaction(
+            lambda connection: connection.execute(
+                "UPDATE ranges SET done = 1 WHERE rowid = ?", (rowid,)
+            )
+        )
+
+    # Ranges leased one after the other as (rowid, scene, start, stop). The caller
+    # completes a range once its outputs are saved, so a range whose processing
+    # fails or whose task is killed is handed out again once its lease expires
+    def ranges(self, owner):
+        while True:
+            lease = self.lease(owner)
+            if lease is None:
+                return
+            yield lease
+
+    def close(self):
+        self.connection.close()